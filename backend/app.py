@@ -1,10 +1,9 @@
-import asyncio
 import json
 import logging
 import os
 import time
 from contextlib import asynccontextmanager
-from typing import Any, AsyncGenerator, Dict
+from typing import AsyncGenerator, Iterator
 
 from dotenv import load_dotenv
 from fastapi import BackgroundTasks, FastAPI, HTTPException
@@ -23,6 +22,8 @@ from models import (
 )
 from pydantic import ValidationError
 from services.agent_service import AgentService
+from services.graph_service import FINAL_RESULT_NODE
+from services.streaming_service import StreamPayload
 from services.config_service import ConfigService
 from services.mcp_service import MCPService
 
@@ -50,6 +51,9 @@ async def lifespan(app: FastAPI):
         tool_count = await mcp_service.get_tool_count()
         logger.info(f"MCP Service initialized with {tool_count} tools")
         
+        # Use persistent checkpoints when available, before any agent is built
+        await agent_service.setup_checkpointer()
+        
         # Initialize agent with default model
         await agent_service.initialize_agent()
         logger.info("Agent Service initialized")
@@ -62,6 +66,7 @@ async def lifespan(app: FastAPI):
     # Shutdown
     logger.info("Shutting down MCP Agent Backend...")
     await mcp_service.cleanup()
+    await agent_service.cleanup()
 
 
 # Create FastAPI app
@@ -141,7 +146,8 @@ async def chat(request: ChatRequest):
             thread_id=request.thread_id,
             timeout_seconds=request.timeout_seconds or 120,
             recursion_limit=request.recursion_limit or 100,
-            enabled_tools=request.enabled_tools
+            enabled_tools=request.enabled_tools,
+            use_cache=request.use_cache is not False
         )
         
         execution_time = time.time() - start_time
@@ -205,18 +211,13 @@ async def chat_stream(request: ChatRequest):
                     yield f"data: {json.dumps({'error': 'Failed to initialize agent'})}\n\n"
                     return
 
-            # Create a queue for real-time streaming
-            chunk_queue = asyncio.Queue()
-            chat_complete = False
-            
             # Track state
             collected_tool_calls = []
             seen_tool_calls = set()
             
-            def streaming_callback(chunk: Dict[str, Any]):
-                """Callback that uses proper LangGraph tool call protocol"""
-                node = chunk.get("node", "")
-                content = chunk.get("content", "")
+            def payload_responses(chunk: StreamPayload) -> Iterator[StreamingChatResponse]:
+                """Responses for one payload, following the LangGraph tool call protocol"""
+                node, content = chunk
                 
                 if node == "agent":
                     # Handle direct text content from OpenAI models
@@ -227,11 +228,8 @@ async def chat_stream(request: ChatRequest):
                             content=content.content,
                             is_complete=False
                         )
-                        try:
-                            chunk_queue.put_nowait(response)
-                        except asyncio.QueueFull:
-                            pass
-                        return response
+                        yield response
+                        return
                     
                     # Handle content with mixed text and tool calls  
                     elif hasattr(content, 'content') and content.content:
@@ -247,11 +245,8 @@ async def chat_stream(request: ChatRequest):
                                                 content=text,
                                                 is_complete=False
                                             )
-                                            try:
-                                                chunk_queue.put_nowait(response)
-                                            except asyncio.QueueFull:
-                                                pass
-                                            return response
+                                            yield response
+                                            return
                                     elif item.get("type") == "tool_use":
                                         # Handle tool calls in content blocks (Anthropic format)
                                         tool_name = item.get('name', 'Unknown')
@@ -272,11 +267,8 @@ async def chat_stream(request: ChatRequest):
                                                 tool_call_id=tool_id,
                                                 is_complete=False
                                             )
-                                            try:
-                                                chunk_queue.put_nowait(response)
-                                            except asyncio.QueueFull:
-                                                pass
-                                            return response
+                                            yield response
+                                            return
                         # Handle plain string content
                         elif isinstance(content.content, str) and content.content.strip():
                             response = StreamingChatResponse(
@@ -284,11 +276,8 @@ async def chat_stream(request: ChatRequest):
                                 content=content.content,
                                 is_complete=False
                             )
-                            try:
-                                chunk_queue.put_nowait(response)
-                            except asyncio.QueueFull:
-                                pass
-                            return response
+                            yield response
+                            return
                     
                     # Handle standard LangGraph tool calls (if not already processed above)
                     elif hasattr(content, 'tool_calls') and content.tool_calls:
@@ -311,11 +300,8 @@ async def chat_stream(request: ChatRequest):
                                     tool_call_id=tool_id,
                                     is_complete=False
                                 )
-                                try:
-                                    chunk_queue.put_nowait(response)
-                                except asyncio.QueueFull:
-                                    pass
-                                return response
+                                yield response
+                                return
                 
                 elif node == "tool_args":
                     # Handle real tool arguments from graph service
@@ -336,10 +322,7 @@ async def chat_stream(request: ChatRequest):
                                 tool_call_id=tool_call_id,
                                 is_complete=False
                             )
-                            try:
-                                chunk_queue.put_nowait(response)
-                            except asyncio.QueueFull:
-                                pass
+                            yield response
                         
                         if args:
                             # Then send the tool input
@@ -350,11 +333,8 @@ async def chat_stream(request: ChatRequest):
                                 tool_call_id=tool_call_id,
                                 is_complete=False
                             )
-                            try:
-                                chunk_queue.put_nowait(response)
-                            except asyncio.QueueFull:
-                                pass
-                            return response
+                            yield response
+                            return
                 
                 elif node == "tools":
                     # Handle tool execution results from tools node
@@ -373,73 +353,44 @@ async def chat_stream(request: ChatRequest):
                                 tool_call_id=result_tool_id,
                                 is_complete=False
                             )
-                            try:
-                                chunk_queue.put_nowait(response)
-                            except asyncio.QueueFull:
-                                pass
-                            return response
-                
-                return None
+                            yield response
+                            return
             
-            # Start the chat in a background task
-            async def run_chat():
-                nonlocal chat_complete
-                try:
-                    await agent_service.chat(
-                        message=request.message,
-                        thread_id=request.thread_id,
-                        timeout_seconds=request.timeout_seconds or 120,
-                        recursion_limit=request.recursion_limit or 100,
-                        callback=streaming_callback,
-                        enabled_tools=request.enabled_tools
-                    )
-                finally:
-                    chat_complete = True
-                    # Signal completion
-                    completion_response = StreamingChatResponse(
-                        type="complete",
-                        content="",
-                        is_complete=True
-                    )
-                    try:
-                        chunk_queue.put_nowait(completion_response)
-                    except asyncio.QueueFull:
-                        pass
-            
-            # Start chat task
-            chat_task = asyncio.create_task(run_chat())
-            
-            # Yield chunks as they become available in real-time
-            while not chat_complete or not chunk_queue.empty():
-                try:
-                    # Wait for a chunk with timeout
-                    chunk_response = await asyncio.wait_for(chunk_queue.get(), timeout=0.1)
-                    data = json.dumps(chunk_response.model_dump())
-                    yield f"data: {data}\n\n"
-                    
-                    if chunk_response.type == "complete":
-                        break
-                        
-                except asyncio.TimeoutError:
-                    # No chunk available, continue waiting
-                    continue
-                except Exception as e:
-                    # Handle any errors
-                    error_response = StreamingChatResponse(
-                        type="error",
-                        content=str(e),
-                        is_complete=True
-                    )
-                    yield f"data: {json.dumps(error_response.model_dump())}\n\n"
-                    break
+            # Forward each payload as soon as the agent produces it
+            stream = agent_service.chat_stream(
+                message=request.message,
+                thread_id=request.thread_id,
+                timeout_seconds=request.timeout_seconds or 120,
+                recursion_limit=request.recursion_limit or 100,
+                enabled_tools=request.enabled_tools,
+                use_cache=request.use_cache is not False
+            )
+            try:
+                async for payload in stream:
+                    if payload.node == FINAL_RESULT_NODE:
+                        continue
+                    for response in payload_responses(payload):
+                        yield f"data: {json.dumps(response.model_dump())}\n\n"
+            except Exception as e:
+                # Handle any errors
+                error_response = StreamingChatResponse(
+                    type="error",
+                    content=str(e),
+                    is_complete=True
+                )
+                yield f"data: {json.dumps(error_response.model_dump())}\n\n"
+                return
+            finally:
+                # Closing on client disconnect too, which cancels the graph run
+                await stream.aclose()
             
-            # Ensure chat task is cleaned up
-            if not chat_task.done():
-                chat_task.cancel()
-                try:
-                    await chat_task
-                except asyncio.CancelledError:
-                    pass
+            # Signal completion
+            completion_response = StreamingChatResponse(
+                type="complete",
+                content="",
+                is_complete=True
+            )
+            yield f"data: {json.dumps(completion_response.model_dump())}\n\n"
             
         except Exception as e:
             error_response = StreamingChatResponse(
@@ -464,7 +415,7 @@ async def chat_stream(request: ChatRequest):
 @app.get("/config")
 async def get_config():
     """Get current MCP configuration"""
-    return mcp_service.get_config()
+    return await mcp_service.get_config()
 
 
 @app.post("/config")
@@ -481,6 +432,7 @@ async def update_config(request: ConfigUpdateRequest):
             raise HTTPException(status_code=500, detail="Failed to update configuration")
         
         # Reinitialize agent with new tools
+        agent_service.invalidate_agent_cache()
         await agent_service.initialize_agent(agent_service.current_model or "claude-sonnet-4-20250514")
         
         return {"message": "Configuration updated successfully", "config": config_dict}
@@ -515,6 +467,7 @@ async def add_tool(tool_name: str, tool_config: dict):
             raise HTTPException(status_code=500, detail=f"Failed to connect to MCP server '{tool_name}'. Configuration not saved.")
         
         # Reinitialize agent with new tools
+        agent_service.invalidate_agent_cache()
         await agent_service.initialize_agent(agent_service.current_model or "claude-sonnet-4-20250514")
         
         return {"message": f"Tool {tool_name} connected successfully and saved to configuration"}
@@ -539,6 +492,7 @@ async def remove_tool(tool_name: str):
             raise HTTPException(status_code=500, detail=f"Failed to remove tool {tool_name}")
         
         # Reinitialize agent
+        agent_service.invalidate_agent_cache()
         await agent_service.initialize_agent(agent_service.current_model or "claude-sonnet-4-20250514")
         
         return {"message": f"Tool {tool_name} removed successfully"}
@@ -1,6 +1,7 @@
 import os
 import logging
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
 from fastmcp import FastMCP
 
 class BaseMCPServer(ABC):
@@ -10,7 +11,7 @@ class BaseMCPServer(ABC):
         """Initialize the MCP server"""
         self.name = name
         self.version = version
-        self.mcp = FastMCP(name=name, instructions=instructions)
+        self.mcp = FastMCP(name=name, instructions=instructions, lifespan=self._lifespan)
         self.logger = logging.getLogger(f"{__name__}.{name}")
         
         self.setup_handlers()
@@ -31,6 +32,18 @@ class BaseMCPServer(ABC):
         """Setup all MCP handlers - must be implemented by subclasses"""
         pass
     
+    @asynccontextmanager
+    async def _lifespan(self, server: FastMCP):
+        """Server lifespan - runs shutdown hooks on the server's event loop"""
+        try:
+            yield {}
+        finally:
+            await self.on_shutdown()
+    
+    async def on_shutdown(self):
+        """Release resources such as HTTP sessions - override in subclasses"""
+        pass
+    
     def run(self, transport: str = "stdio", host: str = None, port: int = None):
         """Run the MCP server"""
         # Suppress FastMCP banner by setting environment variable
@@ -1,13 +1,23 @@
 import os
 import io
-from typing import Optional, Dict, Any, Tuple
+import re
+import asyncio
+import random
+import threading
+from collections import OrderedDict
+import importlib.util
+from typing import Optional, Dict, Any, Tuple, List, AsyncIterator
 from mcp_servers.base import BaseMCPServer
 
 # Google API dependencies
 try:
+    import httplib2
+    import google_auth_httplib2
     from google.oauth2.credentials import Credentials
     from googleapiclient.discovery import build
+    from googleapiclient.errors import HttpError
     from googleapiclient.http import MediaIoBaseDownload
+    from googleapiclient.model import JsonModel
     GOOGLE_AVAILABLE = True
 except ImportError:
     GOOGLE_AVAILABLE = False
@@ -29,6 +39,41 @@ try:
 except ImportError:
     MARKDOWN_SUPPORT = False
 
+# Optional: Faster JSON decoding of Drive API responses
+try:
+    import orjson
+    ORJSON_SUPPORT = True
+except ImportError:
+    ORJSON_SUPPORT = False
+
+# Optional: HTTP/2 transport for Drive GET requests (httpx needs h2 for HTTP/2)
+try:
+    import httpx
+    HTTP2_SUPPORT = importlib.util.find_spec('h2') is not None
+except ImportError:
+    HTTP2_SUPPORT = False
+
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3/'
+
+
+# Line range specs: 'N', ':N', 'N:M', 'N:', '-N', '-N:' (a tail spec takes no end line, so '-5:3' is rejected)
+_LINE_SPEC_RE = re.compile(r'^(-(?!\d*:\d))?(\d*)(?::(\d*))?$')
+
+
+if GOOGLE_AVAILABLE and ORJSON_SUPPORT:
+    class OrjsonModel(JsonModel):
+        """JsonModel that decodes response bodies with orjson"""
+        
+        def deserialize(self, content):
+            try:
+                body = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                # Non-JSON bodies (e.g. exports) keep the stock handling
+                return super().deserialize(content)
+            if self._data_wrapper and isinstance(body, dict) and "data" in body:
+                body = body["data"]
+            return body
+
 
 class GoogleDriveMCPServer(BaseMCPServer):
     """Google Drive MCP Server implementation"""
@@ -40,6 +85,15 @@ class GoogleDriveMCPServer(BaseMCPServer):
         'application/vnd.google-apps.presentation': 'text/plain',
         'application/vnd.google-apps.drawing': 'image/png',
     }
+    WORKSPACE_PREFIX = 'application/vnd.google-apps'
+    
+    # Request throttling: stay under the per-user rate limit and retry transient failures
+    MAX_CONCURRENT_REQUESTS = 8
+    RETRY_STATUSES = (429, 500, 503)
+    MAX_RETRIES = 5
+    
+    # File mime types remembered from earlier reads, oldest forgotten first
+    MAX_KNOWN_MIME_TYPES = 1024
     
     def __init__(self):
         super().__init__(
@@ -48,6 +102,17 @@ class GoogleDriveMCPServer(BaseMCPServer):
             instructions="Google Drive MCP server providing read-only access to files"
         )
         self.service = None
+        self._credentials = None
+        self._local = threading.local()  # Per-thread HTTP objects for concurrent requests
+        self._thread_https: List[Any] = []  # Every per-thread HTTP object, so shutdown can close them
+        self._http2_client = None  # Created lazily on the server's event loop
+        self._sem = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        self._known_mime_types: OrderedDict[str, str] = OrderedDict()  # File id -> mime type from a previous read
+        
+        # Downloaded-content readers keyed by mime type; anything else is read as a regular file
+        self._readers = {
+            'application/pdf': self._read_pdf_file if PDF_SUPPORT else self._read_regular_file,
+        }
     
     def setup_handlers(self):
         """Setup all MCP handlers for Google Drive"""
@@ -106,7 +171,7 @@ class GoogleDriveMCPServer(BaseMCPServer):
             
             Args:
                 folder_id (str): Google Drive folder ID
-                max_results (int, optional): Maximum number of items to return. Defaults to 50.
+                max_results (int, optional): Maximum number of items to return, fetched across pages as needed. Defaults to 50.
                 
             Returns:
                 str: List of files and folders in the specified folder
@@ -153,9 +218,11 @@ class GoogleDriveMCPServer(BaseMCPServer):
             
             # Create credentials from access token
             creds = Credentials(token=access_token)
+            self._credentials = creds
             
             # Build service
-            self.service = build('drive', 'v3', credentials=creds)
+            model = OrjsonModel() if ORJSON_SUPPORT else None
+            self.service = build('drive', 'v3', credentials=creds, model=model)
             self.logger.info("Drive service initialized.")
             
         except Exception as e:
@@ -178,24 +245,30 @@ class GoogleDriveMCPServer(BaseMCPServer):
             
         Returns:
             Tuple of (start_index, end_index) for slicing
+            
+        Raises:
+            ValueError: If the specification is malformed
         """
         if not lines_spec:
             return 0, total_lines
         
+        match = _LINE_SPEC_RE.match(lines_spec.strip())
+        if not match:
+            raise ValueError(f"Invalid line range '{lines_spec}' (a '-N' tail takes no end line)")
+        from_end, first, second = match.groups()
+        
+        # Fast path: single number means first N lines
+        if not from_end and second is None:
+            return 0, min(int(first), total_lines) if first else total_lines
+        
         # Handle negative (last N lines)
-        if lines_spec.startswith('-'):
-            n = int(lines_spec[1:]) if lines_spec[1:] else total_lines
+        if from_end:
+            n = int(first) if first else total_lines
             return max(0, total_lines - n), total_lines
         
         # Handle range formats
-        if ':' in lines_spec:
-            parts = lines_spec.split(':', 1)
-            start = int(parts[0]) - 1 if parts[0] else 0  # Convert to 0-based
-            end = int(parts[1]) if parts[1] else total_lines
-        else:
-            # Single number means first N lines
-            start = 0
-            end = int(lines_spec)
+        start = int(first) - 1 if first else 0  # Convert to 0-based
+        end = int(second) if second else total_lines
         
         # Clamp to valid range
         start = max(0, min(start, total_lines))
@@ -248,25 +321,21 @@ class GoogleDriveMCPServer(BaseMCPServer):
                 'fields': 'files(id, name, mimeType, modifiedTime, size)'
             }
             
-            results = self.service.files().list(**params).execute()
+            results = await self._files_list(**params)
             files = results.get('files', [])
             
             if not files:
                 return "No files found in Google Drive."
             
-            file_list = []
-            for file in files:
-                name = file.get('name', 'Unnamed')
-                file_id = file.get('id', 'Unknown')
-                mime_type = file.get('mimeType', 'unknown')
-                modified = file.get('modifiedTime', 'Unknown')
-                
-                file_list.append(f"• {name} ({mime_type})")
-                file_list.append(f"  ID: {file_id}")
-                file_list.append(f"  Modified: {modified}")
-                file_list.append("")
+            # One pre-formatted multi-line record per file
+            file_list = "\n".join(
+                f"• {file.get('name', 'Unnamed')} ({file.get('mimeType', 'unknown')})\n"
+                f"  ID: {file.get('id', 'Unknown')}\n"
+                f"  Modified: {file.get('modifiedTime', 'Unknown')}\n"
+                for file in files
+            )
             
-            return f"Recent files from Google Drive:\n\n" + "\n".join(file_list)
+            return f"Recent files from Google Drive:\n\n{file_list}"
             
         except Exception as e:
             return f"Error listing files: {str(e)}"
@@ -283,32 +352,204 @@ class GoogleDriveMCPServer(BaseMCPServer):
             escaped_query = query.replace('\\', '\\\\').replace("'", "\\'")
             formatted_query = f"fullText contains '{escaped_query}'"
             
-            results = self.service.files().list(
+            results = await self._files_list(
                 q=formatted_query,
                 pageSize=10,
                 fields='files(id, name, mimeType, modifiedTime, size)'
-            ).execute()
+            )
             
             files = results.get('files', [])
             
             if not files:
                 return f"No files found matching '{query}'"
             
-            file_list = []
-            for file in files:
-                name = file.get('name', 'Unnamed')
-                file_id = file.get('id', 'Unknown')
-                mime_type = file.get('mimeType', 'unknown')
-                
-                file_list.append(f"• {name} ({mime_type})")
-                file_list.append(f"  ID: {file_id}")
-                file_list.append("")
+            file_list = "\n".join(
+                f"• {file.get('name', 'Unnamed')} ({file.get('mimeType', 'unknown')})\n"
+                f"  ID: {file.get('id', 'Unknown')}\n"
+                for file in files
+            )
             
-            return f"Found {len(files)} files matching '{query}':\n\n" + "\n".join(file_list)
+            return f"Found {len(files)} files matching '{query}':\n\n{file_list}"
             
         except Exception as e:
             return f"Error searching files: {str(e)}"
     
+    def _thread_http(self):
+        """Get an authorized HTTP object owned by the calling thread (httplib2 is not thread-safe)"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self._credentials, http=httplib2.Http())
+            self._local.http = http
+            self._thread_https.append(http)
+        return http
+    
+    def _retry_status(self, error: Exception) -> Optional[int]:
+        """Get the HTTP status of a rate limit or transient server error, or None if not retryable"""
+        if isinstance(error, HttpError):
+            status = error.resp.status
+            content = error.content.decode('utf-8', errors='ignore') if isinstance(error.content, bytes) else str(error.content)
+        elif HTTP2_SUPPORT and isinstance(error, httpx.HTTPStatusError):
+            status = error.response.status_code
+            content = error.response.text
+        else:
+            return None
+        
+        if status in self.RETRY_STATUSES:
+            return status
+        # Drive reports quota exhaustion as 403 rateLimitExceeded / userRateLimitExceeded
+        if status == 403 and ('rateLimitExceeded' in content or 'RateLimitExceeded' in content):
+            return status
+        return None
+    
+    async def _call_with_retry(self, call, retry: bool = True):
+        """Await a Drive call, bounded by the concurrency limit.
+        
+        Rate-limited and transient failures are retried with exponential backoff and jitter.
+        
+        Args:
+            call: Zero-argument callable returning the awaitable to run on each attempt
+            retry: Whether failures are retried; speculative calls make a single attempt
+        """
+        max_retries = self.MAX_RETRIES if retry else 0
+        backoff = 1.0
+        for attempt in range(max_retries + 1):
+            async with self._sem:
+                try:
+                    return await call()
+                except Exception as e:
+                    status = self._retry_status(e)
+                    if attempt == max_retries or status is None:
+                        raise
+            
+            # Back off outside the semaphore so other requests can proceed
+            delay = backoff + random.uniform(0, 1)
+            self.logger.warning(f"Drive API returned {status}, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.MAX_RETRIES})")
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, 32)
+    
+    def _execute_blocking(self, request) -> Dict[str, Any]:
+        """Execute a googleapiclient request on the calling thread's own HTTP object"""
+        return request.execute(http=self._thread_http())
+    
+    async def _execute(self, request) -> Dict[str, Any]:
+        """Run a googleapiclient request without stalling the event loop"""
+        return await self._call_with_retry(lambda: asyncio.to_thread(self._execute_blocking, request))
+    
+    def _get_http2_client(self) -> "httpx.AsyncClient":
+        """Get the shared HTTP/2 client; concurrent requests are multiplexed over one connection"""
+        if self._http2_client is None or self._http2_client.is_closed:
+            self._http2_client = httpx.AsyncClient(
+                base_url=DRIVE_API_URL,
+                http2=True,
+                limits=httpx.Limits(max_connections=20),
+                timeout=30.0
+            )
+        return self._http2_client
+    
+    async def _api_get(self, path: str, params: Dict[str, Any], retry: bool = True) -> "httpx.Response":
+        """Send a GET request to the Drive REST API over HTTP/2"""
+        params = {key: value for key, value in params.items() if value is not None}
+        
+        async def call():
+            response = await self._get_http2_client().get(
+                path,
+                params=params,
+                headers={'Authorization': f"Bearer {self._credentials.token}"}
+            )
+            response.raise_for_status()
+            return response
+        
+        return await self._call_with_retry(call, retry)
+    
+    async def _files_list(self, **params) -> Dict[str, Any]:
+        """files.list, over HTTP/2 when available"""
+        if HTTP2_SUPPORT:
+            response = await self._api_get('files', params)
+            return orjson.loads(response.content) if ORJSON_SUPPORT else response.json()
+        return await self._execute(self.service.files().list(**params))
+    
+    async def _files_get(self, file_id: str, **params) -> Dict[str, Any]:
+        """files.get (metadata), over HTTP/2 when available"""
+        if HTTP2_SUPPORT:
+            response = await self._api_get(f'files/{file_id}', params)
+            return orjson.loads(response.content) if ORJSON_SUPPORT else response.json()
+        return await self._execute(self.service.files().get(fileId=file_id, **params))
+    
+    def _download_bytes(self, file_id: str) -> bytes:
+        """Download raw file content (blocking)"""
+        request = self.service.files().get_media(fileId=file_id)
+        request.http = self._thread_http()
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request)
+        
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+        
+        return fh.getvalue()
+    
+    async def _download_bytes_async(self, file_id: str, retry: bool = True) -> bytes:
+        """Download raw file content without stalling the event loop"""
+        if HTTP2_SUPPORT:
+            response = await self._api_get(f'files/{file_id}', {'alt': 'media'}, retry)
+            return response.content
+        return await self._call_with_retry(lambda: asyncio.to_thread(self._download_bytes, file_id), retry)
+    
+    def _remember_mime_type(self, file_id: str, mime_type: str):
+        """Record a file's mime type so the next read knows whether to download speculatively"""
+        self._known_mime_types[file_id] = mime_type
+        self._known_mime_types.move_to_end(file_id)
+        if len(self._known_mime_types) > self.MAX_KNOWN_MIME_TYPES:
+            self._known_mime_types.popitem(last=False)
+    
+    @staticmethod
+    def _discard_task(task: asyncio.Task):
+        """Cancel a speculative task and swallow whatever it ends with"""
+        task.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    
+    async def _iter_folder_pages(self, query: str, max_results: int) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Yield pages of a folder listing, prefetching the next page while the caller formats the current one.
+        
+        Args:
+            query: Drive search query selecting the folder items
+            max_results: Total number of items to yield across all pages
+        """
+        fields = 'nextPageToken, files(id, name, mimeType, modifiedTime)'
+        
+        def list_page(page_token: Optional[str], page_size: int):
+            return self._files_list(
+                q=query,
+                pageSize=min(page_size, 1000),  # Drive API maximum page size
+                pageToken=page_token,
+                fields=fields,
+                orderBy='name'
+            )
+        
+        remaining = max_results
+        page = await list_page(None, remaining)
+        
+        while True:
+            files = page.get('files', [])[:remaining]
+            remaining -= len(files)
+            next_token = page.get('nextPageToken')
+            
+            # Start fetching the next page before handing this one to the caller
+            prefetch = None
+            if next_token and remaining > 0:
+                prefetch = asyncio.create_task(list_page(next_token, remaining))
+            
+            try:
+                yield files
+            except BaseException:
+                if prefetch:
+                    prefetch.cancel()
+                raise
+            
+            if prefetch is None:
+                return
+            page = await prefetch
+    
     async def _list_folder_contents(self, folder_id: str, max_results: Optional[int] = None) -> str:
         """List contents of a specific folder"""
         if not GOOGLE_AVAILABLE:
@@ -323,60 +564,43 @@ class GoogleDriveMCPServer(BaseMCPServer):
             # Query for items in the specific folder
             query = f"'{folder_id}' in parents and trashed=false"
             
-            results = self.service.files().list(
-                q=query,
-                pageSize=min(max_results, 100),  # Limit to 100 max
-                fields='files(id, name, mimeType, modifiedTime, size, parents)',
-                orderBy='name'
-            ).execute()
+            # Separate folders from files, formatting each record as it is seen
+            folder_lines = []
+            doc_lines = []
+            total = 0
             
-            files = results.get('files', [])
-            
-            if not files:
-                return f"No files or folders found in the specified folder."
-            
-            # Separate folders from files
-            folders = []
-            documents = []
-            
-            for file in files:
-                name = file.get('name', 'Unnamed')
-                file_id = file.get('id', 'Unknown')
-                mime_type = file.get('mimeType', 'unknown')
-                modified = file.get('modifiedTime', 'Unknown')
-                
-                item_info = {
-                    'name': name,
-                    'id': file_id,
-                    'mime_type': mime_type,
-                    'modified': modified
-                }
+            async for files in self._iter_folder_pages(query, max_results):
+                total += len(files)
                 
-                if mime_type == 'application/vnd.google-apps.folder':
-                    folders.append(item_info)
-                else:
-                    documents.append(item_info)
+                for file in files:
+                    name = file.get('name', 'Unnamed')
+                    file_id = file.get('id', 'Unknown')
+                    mime_type = file.get('mimeType', 'unknown')
+                    
+                    if mime_type == 'application/vnd.google-apps.folder':
+                        folder_lines.append(f"  • {name} (Folder)\n    ID: {file_id}")
+                    else:
+                        doc_lines.append(
+                            f"  • {name} ({self._get_file_type_description(mime_type)})\n"
+                            f"    ID: {file_id}\n"
+                            f"    Modified: {file.get('modifiedTime', 'Unknown')}\n"
+                        )
+            
+            if not total:
+                return f"No files or folders found in the specified folder."
             
             # Build response
-            result_lines = [f"Contents of folder (found {len(files)} items):"]
+            result_lines = [f"Contents of folder (found {total} items):"]
             result_lines.append("")
             
-            if folders:
+            if folder_lines:
                 result_lines.append("Folders:")
-                for folder in folders:
-                    result_lines.append(f"  • {folder['name']} (Folder)")
-                    result_lines.append(f"    ID: {folder['id']}")
+                result_lines.extend(folder_lines)
                 result_lines.append("")
             
-            if documents:
+            if doc_lines:
                 result_lines.append("Files:")
-                for doc in documents:
-                    # Get file type description
-                    type_desc = self._get_file_type_description(doc['mime_type'])
-                    result_lines.append(f"  • {doc['name']} ({type_desc})")
-                    result_lines.append(f"    ID: {doc['id']}")
-                    result_lines.append(f"    Modified: {doc['modified']}")
-                    result_lines.append("")
+                result_lines.extend(doc_lines)
             
             return "\n".join(result_lines)
             
@@ -404,47 +628,60 @@ class GoogleDriveMCPServer(BaseMCPServer):
         if not GOOGLE_AVAILABLE:
             return "Google Drive functionality not available - missing dependencies"
         
+        # Reject malformed line ranges before touching the network
+        if lines and not _LINE_SPEC_RE.match(lines.strip()):
+            return f"Error: invalid line range '{lines}'. Use '10', '5:15', '20:' or '-10' (a '-N' tail takes no end line)."
+        
         try:
             self._ensure_service()
             
-            # Get file metadata
-            file = self.service.files().get(
-                fileId=file_id,
-                fields='mimeType, name'
-            ).execute()
+            # Workspace documents reject media downloads, so the download only starts alongside the
+            # metadata fetch for files an earlier read showed to be regular; it makes a single attempt
+            known_mime_type = self._known_mime_types.get(file_id)
+            media_task = None
+            if known_mime_type is not None and not known_mime_type.startswith(self.WORKSPACE_PREFIX):
+                media_task = asyncio.create_task(self._download_bytes_async(file_id, retry=False))
+            
+            try:
+                file = await self._files_get(file_id, fields='mimeType, name')
+            except BaseException:
+                if media_task is not None:
+                    self._discard_task(media_task)
+                raise
             
             mime_type = file.get('mimeType', 'application/octet-stream')
             file_name = file.get('name', 'unnamed')
+            self._remember_mime_type(file_id, mime_type)
             
             # Handle Google Workspace files
-            if mime_type.startswith('application/vnd.google-apps'):
+            if mime_type.startswith(self.WORKSPACE_PREFIX):
+                if media_task is not None:
+                    self._discard_task(media_task)
                 return await self._read_workspace_file(file_id, mime_type, file_name, lines)
             
-            # Handle PDFs specially
-            if mime_type == 'application/pdf' and PDF_SUPPORT:
-                return await self._read_pdf_file(file_id, file_name, lines)
+            content = None
+            if media_task is not None:
+                try:
+                    content = await media_task
+                except Exception:
+                    pass  # Fall back to a download with the usual retries
+            if content is None:
+                try:
+                    content = await self._download_bytes_async(file_id)
+                except Exception as e:
+                    return f"Error reading file {file_name}: {e}"
             
-            # Handle regular files
-            return await self._read_regular_file(file_id, mime_type, file_name, lines)
+            handler = self._readers.get(mime_type, self._read_regular_file)
+            return await handler(content, mime_type, file_name, lines)
             
         except Exception as e:
             return f"Error reading file: {str(e)}"
     
-    async def _read_pdf_file(self, file_id: str, file_name: str, lines: Optional[str] = None) -> str:
+    async def _read_pdf_file(self, content: bytes, mime_type: str, file_name: str, lines: Optional[str] = None) -> str:
         """Extract text from PDF files"""
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            
-            fh.seek(0)
-            
             # Extract text from PDF
-            pdf_reader = pypdf.PdfReader(fh)
+            pdf_reader = pypdf.PdfReader(io.BytesIO(content))
             text_content = []
             
             for page_num, page in enumerate(pdf_reader.pages, 1):
@@ -471,10 +708,10 @@ class GoogleDriveMCPServer(BaseMCPServer):
                 return f"File {file_name} is a drawing/image and cannot be read as text."
             else:
                 # Text export for documents
-                response = self.service.files().export(
+                response = await self._execute(self.service.files().export(
                     fileId=file_id,
                     mimeType=export_mime_type
-                ).execute()
+                ))
                 
                 text = response.decode('utf-8') if isinstance(response, bytes) else response
                 
@@ -486,19 +723,9 @@ class GoogleDriveMCPServer(BaseMCPServer):
         except Exception as e:
             return f"Error reading workspace file {file_name}: {e}"
     
-    async def _read_regular_file(self, file_id: str, mime_type: str, file_name: str, lines: Optional[str] = None) -> str:
+    async def _read_regular_file(self, content: bytes, mime_type: str, file_name: str, lines: Optional[str] = None) -> str:
         """Read regular files from Drive"""
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-            
-            content = fh.getvalue()
-            
             # Handle HTML files - optionally convert to markdown
             if mime_type == 'text/html' and MARKDOWN_SUPPORT:
                 try:
@@ -525,6 +752,19 @@ class GoogleDriveMCPServer(BaseMCPServer):
         except Exception as e:
             return f"Error reading file {file_name}: {e}"
     
+    async def on_shutdown(self):
+        """Close the shared HTTP/2 client and the per-thread httplib2 connections"""
+        if self._http2_client is not None:
+            await self._http2_client.aclose()
+            self._http2_client = None
+        
+        # Threads create a fresh HTTP object on their next request
+        self._local = threading.local()
+        while self._thread_https:
+            self._thread_https.pop().close()
+        if self.service is not None:
+            self.service.close()
+    
     def start(self, transport: str = "stdio", host: str = None, port: int = None):
         """Start the server"""
         if not GOOGLE_AVAILABLE:
@@ -1,20 +1,48 @@
 import os
-from typing import Optional, Dict, Any
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, Awaitable, Callable, List, Tuple
 from mcp_servers.base import BaseMCPServer
 
 # Optional: Import weather API libraries
 try:
-    import requests
-    REQUESTS_AVAILABLE = True
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
 except ImportError:
-    REQUESTS_AVAILABLE = False
+    AIOHTTP_AVAILABLE = False
     import logging
-    logging.getLogger(__name__).warning("requests not installed. Using mock weather data.")
+    logging.getLogger(__name__).warning("aiohttp not installed. Using mock weather data.")
+
+# Optional: Redis cache for upstream weather responses
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
 
 
 class WeatherMCPServer(BaseMCPServer):
     """Weather MCP Server implementation for weather information"""
     
+    # Cache lifetimes in seconds (weather barely changes minute-to-minute)
+    WEATHER_CACHE_TTL = 300
+    FORECAST_CACHE_TTL = 1800
+    STALE_CACHE_TTL = 86400  # Last good response, served when the upstream API fails
+    
+    WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
+    FORECAST_URL = "http://api.openweathermap.org/data/2.5/forecast"
+    
+    # Mock data used when no API key is configured
+    MOCK_WEATHER_CONDITIONS = (
+        ("Sunny", "25°C", "Low humidity, perfect day!"),
+        ("Partly Cloudy", "22°C", "Comfortable with some clouds"),
+        ("Rainy", "18°C", "Light rain expected"),
+        ("Overcast", "20°C", "Cloudy but pleasant"),
+        ("Sunny", "28°C", "Warm and bright")
+    )
+    MOCK_FORECAST_CONDITIONS = ("Sunny", "Partly Cloudy", "Cloudy", "Light Rain", "Clear")
+    
     def __init__(self):
         super().__init__(
             name="Weather",
@@ -22,7 +50,14 @@ class WeatherMCPServer(BaseMCPServer):
             instructions="You are a weather assistant that can answer questions about the weather in a given location."
         )
         self.api_key = os.environ.get('OPENWEATHER_API_KEY')
-        self.use_real_api = REQUESTS_AVAILABLE and self.api_key
+        self.use_real_api = AIOHTTP_AVAILABLE and self.api_key
+        self._base_params = {'appid': self.api_key, 'units': 'metric'}  # Shared by every OWM request
+        self._session: Optional["aiohttp.ClientSession"] = None  # Shared, created on first request
+        self._inflight: Dict[str, asyncio.Task] = {}  # Upstream fetches in progress, by cache key
+        
+        # Response cache, enabled by setting REDIS_URL
+        redis_url = os.environ.get('REDIS_URL')
+        self._redis = aioredis.from_url(redis_url) if REDIS_AVAILABLE and redis_url else None
         
         if not self.use_real_api:
             self.logger.info("Using mock weather data. Set OPENWEATHER_API_KEY for real weather.")
@@ -59,6 +94,109 @@ class WeatherMCPServer(BaseMCPServer):
                 str: Weather forecast information
             """
             return await self._get_forecast(location, days)
+        
+        @self.tool()
+        async def get_weather_batch(locations: List[str]) -> str:
+            """
+            Get current weather information for several locations at once.
+            
+            Prefer this over calling get_weather repeatedly when the user asks about
+            more than one location; all lookups run concurrently.
+            
+            Args:
+                locations (List[str]): The names of the locations to get weather for
+                
+            Returns:
+                str: Weather information for each location, separated by blank lines
+            """
+            results = await asyncio.gather(
+                *(self._get_weather(location) for location in locations),
+                return_exceptions=True
+            )
+            return "\n\n".join(
+                f"Error fetching weather for {location}: {str(result)}" if isinstance(result, Exception) else result
+                for location, result in zip(locations, results)
+            )
+    
+    def _get_session(self) -> "aiohttp.ClientSession":
+        """Get the shared HTTP session, reusing pooled keep-alive connections across requests"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20, limit_per_host=10, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=10)
+            )
+        return self._session
+    
+    async def _fetch_json(self, url: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """GET a JSON document without blocking the event loop"""
+        async with self._get_session().get(url, params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+    
+    async def _cache_get(self, key: str) -> Optional[str]:
+        """Get a cached response, or None on a miss or cache failure"""
+        if self._redis is None:
+            return None
+        try:
+            cached = await self._redis.get(key)
+        except Exception as e:
+            self.logger.warning(f"Weather cache read failed: {e}")
+            return None
+        return cached.decode('utf-8') if cached is not None else None
+    
+    async def _cache_set(self, key: str, value: str, ttl: int):
+        """Cache a response along with a long-lived stale copy, ignoring cache failures"""
+        if self._redis is None:
+            return
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.set(key, value, ex=ttl)
+                pipe.hset(f"{key}:stale", mapping={
+                    'data': value,
+                    'fetched_at': datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S %Z")
+                })
+                pipe.expire(f"{key}:stale", self.STALE_CACHE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            self.logger.warning(f"Weather cache write failed: {e}")
+    
+    async def _cache_get_stale(self, key: str) -> Optional[Tuple[str, str]]:
+        """Get the last good response and when it was fetched, or None"""
+        if self._redis is None:
+            return None
+        try:
+            stale = await self._redis.hgetall(f"{key}:stale")
+        except Exception as e:
+            self.logger.warning(f"Weather cache read failed: {e}")
+            return None
+        if not stale or b'data' not in stale:
+            return None
+        return stale[b'data'].decode('utf-8'), stale.get(b'fetched_at', b'unknown time').decode('utf-8')
+    
+    async def _stale_or_error(self, key: str, error: str) -> str:
+        """Serve the stale copy of a response when the upstream API fails"""
+        stale = await self._cache_get_stale(key)
+        if stale is None:
+            return error
+        data, fetched_at = stale
+        return f"{data}\n(cached from {fetched_at}; upstream unavailable)"
+    
+    async def _singleflight(self, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        """Share one in-flight upstream fetch between concurrent callers for the same key"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one caller being cancelled doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+    
+    async def on_shutdown(self):
+        """Close the shared HTTP session and cache connection"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        if self._redis is not None:
+            await self._redis.aclose()
     
     async def _get_weather(self, location: str) -> str:
         """Internal method to get current weather"""
@@ -69,50 +207,44 @@ class WeatherMCPServer(BaseMCPServer):
     
     async def _get_real_weather(self, location: str) -> str:
         """Get real weather data from OpenWeatherMap API"""
+        cache_key = f"owm:weather:metric:{location.strip().lower()}"
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
+        return await self._singleflight(cache_key, lambda: self._fetch_real_weather(location, cache_key))
+    
+    async def _fetch_real_weather(self, location: str, cache_key: str) -> str:
+        """Fetch current weather from OpenWeatherMap and cache it"""
         try:
-            url = f"http://api.openweathermap.org/data/2.5/weather"
-            params = {
-                'q': location,
-                'appid': self.api_key,
-                'units': 'metric'
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await self._fetch_json(self.WEATHER_URL, {**self._base_params, 'q': location})
             
             temp = data['main']['temp']
             feels_like = data['main']['feels_like']
             humidity = data['main']['humidity']
             description = data['weather'][0]['description'].title()
             
-            return f"Weather in {location}:\n" \
-                   f"Temperature: {temp}°C (feels like {feels_like}°C)\n" \
-                   f"Conditions: {description}\n" \
-                   f"Humidity: {humidity}%"
+            # Name the place as OpenWeatherMap resolved it; the cached reply is shared by every spelling of the key
+            place = data.get('name') or location.strip()
+            result = f"Weather in {place}:\n" \
+                     f"Temperature: {temp}°C (feels like {feels_like}°C)\n" \
+                     f"Conditions: {description}\n" \
+                     f"Humidity: {humidity}%"
             
-        except requests.exceptions.RequestException as e:
-            return f"Error fetching weather data: {str(e)}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return await self._stale_or_error(cache_key, f"Error fetching weather data: {str(e)}")
         except KeyError as e:
             return f"Error parsing weather data: {str(e)}"
         except Exception as e:
             return f"Unexpected error: {str(e)}"
+        
+        await self._cache_set(cache_key, result, self.WEATHER_CACHE_TTL)
+        return result
     
     async def _get_mock_weather(self, location: str) -> str:
         """Return mock weather data"""
         # Mock weather responses with some variety
-        import random
-        
-        conditions = [
-            ("Sunny", "25°C", "Low humidity, perfect day!"),
-            ("Partly Cloudy", "22°C", "Comfortable with some clouds"),
-            ("Rainy", "18°C", "Light rain expected"),
-            ("Overcast", "20°C", "Cloudy but pleasant"),
-            ("Sunny", "28°C", "Warm and bright")
-        ]
-        
-        condition, temp, description = random.choice(conditions)
+        condition, temp, description = random.choice(self.MOCK_WEATHER_CONDITIONS)
         
         return f"Mock Weather in {location}:\n" \
                f"Temperature: {temp}\n" \
@@ -133,19 +265,18 @@ class WeatherMCPServer(BaseMCPServer):
     
     async def _get_real_forecast(self, location: str, days: int) -> str:
         """Get real forecast data from OpenWeatherMap API"""
+        cache_key = f"owm:forecast:metric:{days}:{location.strip().lower()}"
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
+        return await self._singleflight(cache_key, lambda: self._fetch_real_forecast(location, days, cache_key))
+    
+    async def _fetch_real_forecast(self, location: str, days: int, cache_key: str) -> str:
+        """Fetch forecast data from OpenWeatherMap and cache it"""
         try:
-            url = f"http://api.openweathermap.org/data/2.5/forecast"
-            params = {
-                'q': location,
-                'appid': self.api_key,
-                'units': 'metric',
-                'cnt': days * 8  # API returns 3-hour intervals, 8 per day
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            
-            data = response.json()
+            # API returns 3-hour intervals, 8 per day
+            data = await self._fetch_json(self.FORECAST_URL, {**self._base_params, 'q': location, 'cnt': days * 8})
             
             # Group by day and get daily summary
             daily_forecasts = []
@@ -172,24 +303,27 @@ class WeatherMCPServer(BaseMCPServer):
                 conditions = day_data[len(day_data)//2]['weather'][0]['description'].title()
                 daily_forecasts.append(f"{current_date}: {avg_temp:.1f}°C, {conditions}")
             
-            return f"{days}-day forecast for {location}:\n" + "\n".join(daily_forecasts[:days])
+            # Name the place as OpenWeatherMap resolved it; the cached reply is shared by every spelling of the key
+            place = data.get('city', {}).get('name') or location.strip()
+            result = f"{days}-day forecast for {place}:\n" + "\n".join(daily_forecasts[:days])
             
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return await self._stale_or_error(cache_key, f"Error fetching forecast: {str(e)}")
         except Exception as e:
             return f"Error fetching forecast: {str(e)}"
+        
+        await self._cache_set(cache_key, result, self.FORECAST_CACHE_TTL)
+        return result
     
     async def _get_mock_forecast(self, location: str, days: int) -> str:
         """Return mock forecast data"""
-        import random
-        from datetime import datetime, timedelta
-        
-        conditions = ["Sunny", "Partly Cloudy", "Cloudy", "Light Rain", "Clear"]
+        today = datetime.now()
+        conditions = random.choices(self.MOCK_FORECAST_CONDITIONS, k=days)
         
-        forecasts = []
-        for i in range(days):
-            date = (datetime.now() + timedelta(days=i)).strftime("%Y-%m-%d")
-            temp = random.randint(15, 30)
-            condition = random.choice(conditions)
-            forecasts.append(f"{date}: {temp}°C, {condition}")
+        forecasts = [
+            f"{(today + timedelta(days=i)).strftime('%Y-%m-%d')}: {random.randrange(15, 31)}°C, {condition}"
+            for i, condition in enumerate(conditions)
+        ]
         
         return f"Mock {days}-day forecast for {location}:\n" + "\n".join(forecasts) + \
                "\n(This is mock data - set OPENWEATHER_API_KEY for real weather)"
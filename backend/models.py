@@ -1,4 +1,5 @@
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import partial
 from typing import Any, Dict, List, Optional
 
 from pydantic import BaseModel, Field
@@ -26,6 +27,7 @@ class ChatRequest(BaseModel):
     recursion_limit: Optional[int] = Field(default=100, description="Recursion limit")
     thread_id: Optional[str] = None
     enabled_tools: Optional[List[str]] = Field(default=None, description="List of enabled tool server names")
+    use_cache: Optional[bool] = Field(default=True, description="Allow serving and storing cached responses")
 
 
 class ToolCall(BaseModel):
@@ -80,5 +82,5 @@ class ConfigUpdateRequest(BaseModel):
 
 class HealthResponse(BaseModel):
     status: str = "healthy"
-    timestamp: datetime = Field(default_factory=datetime.now)
+    timestamp: datetime = Field(default_factory=partial(datetime.now, tz=timezone.utc))
     services: Dict[str, str] = Field(default_factory=dict)
\ No newline at end of file
@@ -1,28 +1,49 @@
 import asyncio
+import hashlib
 import logging
 import os
-import sys
+import secrets
 import uuid
-from typing import Any, Callable, Dict, List, Optional
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
 
+import httpx
 from langchain_anthropic import ChatAnthropic
-from langchain_core.messages import HumanMessage
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph.state import CompiledStateGraph
 
-sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
-from services.graph_service import GraphService
-from services.mcp_service import MCPService
+# Optional: Persistent checkpoints in SQLite (falls back to in-memory)
+try:
+    import aiosqlite
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+    SQLITE_CHECKPOINT_SUPPORT = True
+except ImportError:
+    SQLITE_CHECKPOINT_SUPPORT = False
+
+from .cache_service import ResponseCache, SemanticCache
+from .graph_service import FINAL_RESULT_NODE, GraphService
+from .mcp_service import MCPService
+from .streaming_service import StreamPayload
 
 logger = logging.getLogger(__name__)
 
+# Supported models: chat model class, output token limit, the API key that enables it and
+# the constructor argument for an injected httpx client (ChatAnthropic already shares a pooled client)
+MODEL_REGISTRY: Dict[str, Dict[str, Any]] = {
+    "claude-sonnet-4-20250514": {"provider": ChatAnthropic, "max_tokens": 64000, "api_key_env": "ANTHROPIC_API_KEY", "http_client_arg": None},
+    "gpt-5-mini": {"provider": ChatOpenAI, "max_tokens": 16000, "api_key_env": "OPENAI_API_KEY", "http_client_arg": "http_async_client"},
+}
+DEFAULT_MODEL = "claude-sonnet-4-20250514"
+
 
 # Utility functions
 def random_uuid() -> str:
-    """Generate a random UUID string"""
-    return str(uuid.uuid4())
+    """Generate a random UUID4 string from the OS CSPRNG"""
+    return str(uuid.UUID(bytes=secrets.token_bytes(16), version=4))
 
 
 class AgentService:
@@ -30,87 +51,105 @@ class AgentService:
         self.mcp_service = mcp_service
         self.agent: Optional[CompiledStateGraph] = None
         self.current_model: Optional[str] = None
-        self.current_graph_type: str = "simple"  # "simple" or "extended"
-        self.checkpointer = MemorySaver()
+        self._set_graph_type("simple")  # "simple" or "extended"
+        self.checkpointer = MemorySaver()  # Replaced by SQLite in setup_checkpointer() when available
+        self._checkpoint_conn = None
         self.graph_service = GraphService()
-        
-        # Output token limits for different models
-        self.output_token_info = {
-            "claude-sonnet-4-20250514": {"max_tokens": 64000},  # Max output tokens for Claude Sonnet 4
-            "gpt-5-mini": {"max_tokens": 16000},
-        }
+        self.response_cache = ResponseCache(redis_url=os.environ.get("REDIS_URL"))
+        self.semantic_cache = SemanticCache(model_name=os.environ.get("SEMANTIC_CACHE_MODEL"))
+        self._available_models = self._detect_available_models()  # API keys don't change at runtime
+        self._model_cache: Dict[str, BaseChatModel] = {}  # Reused across agent re-initializations
+        self._http_client: Optional[httpx.AsyncClient] = None  # Shared connection pool for model APIs
+        self._agent_cache: OrderedDict[tuple, tuple[CompiledStateGraph, List[str]]] = OrderedDict()  # LRU of (graph, tool names)
+        self._agent_key: Optional[tuple] = None  # Cache key of the current agent
+        self.tool_names: List[str] = []  # Names of the tools bound to the current agent
+        self.max_cached_agents = 16
+        self._init_lock = asyncio.Lock()  # Guards agent (re)builds
 
         # System prompt for the agent
         self.system_prompt = """You are an expert AI assistant with access to powerful tools. Use tools strategically to thoroughly address user requests. When you find relevant information, explore it further if needed. Provide comprehensive, well-structured responses."""
+        self.system_prompt_version = hashlib.sha256(self.system_prompt.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def _detect_available_models() -> tuple:
+        """Detect models whose API keys are set in the environment"""
+        available_models = tuple(
+            model_name for model_name, spec in MODEL_REGISTRY.items()
+            if os.environ.get(spec["api_key_env"])
+        )
+        return available_models or (DEFAULT_MODEL,)  # Default fallback
 
     def get_available_models(self) -> List[str]:
         """Get list of available models based on API keys"""
-        import os
-        
-        available_models = []
-        
-        # Check Anthropic API key
-        if os.environ.get("ANTHROPIC_API_KEY"):
-            available_models.append("claude-sonnet-4-20250514")
-        
-        # Check OpenAI API key
-        if os.environ.get("OPENAI_API_KEY"):
-            available_models.append("gpt-5-mini")
-        
-        return available_models or ["claude-sonnet-4-20250514"]  # Default fallback
+        return list(self._available_models)
 
-    async def initialize_agent(self, model_name: str = "claude-sonnet-4-20250514", enabled_tools: Optional[List[str]] = None, graph_type: str = "simple") -> bool:
+    def refresh_available_models(self) -> List[str]:
+        """Re-detect available models, e.g. after API keys were changed at runtime"""
+        self._available_models = self._detect_available_models()
+        return self.get_available_models()
+
+    async def initialize_agent(self, model_name: str = DEFAULT_MODEL, enabled_tools: Optional[List[str]] = None, graph_type: str = "simple") -> bool:
         """Initialize agent with specified model and available tools"""
         try:
-            # Ensure MCP service is initialized
-            if not self.mcp_service.is_initialized():
-                await self.mcp_service.initialize()
-            
-            # Get filtered tools if enabled_tools is provided, otherwise get all tools
-            if enabled_tools:
-                tools = await self.mcp_service.get_filtered_tools(enabled_tools)
-            else:
-                tools = await self.mcp_service.get_tools()
-            
-            if not tools:
-                return False
-
-            # Initialize the appropriate model
-            if model_name == "claude-sonnet-4-20250514":
-                model = ChatAnthropic(
-                    model=model_name,
-                    temperature=0.1,
-                    max_tokens=self.output_token_info[model_name]["max_tokens"],
-                )
-            elif model_name == "gpt-5-mini":
-                model = ChatOpenAI(
-                    model=model_name,
-                    temperature=0.1,
-                    max_tokens=self.output_token_info[model_name]["max_tokens"],
-                )
-            else:
-                raise ValueError(f"Unsupported model: {model_name}")
-
-            # Create agent based on graph type using graph_service
-            if graph_type == "simple":
-                # Traditional ReAct agent - fast and simple
-                self.agent = self.graph_service.create_react_graph(
-                    model=model,
-                    tools=tools,
-                    system_prompt=self.system_prompt,
-                    checkpointer=self.checkpointer
-                )
-            else:  # extended
-                # Reflection-based agent - dynamic and thorough
-                self.agent = self.graph_service.create_reflection_graph(
-                    model=model,
-                    tools=tools,
-                    system_prompt=self.system_prompt
-                )
+            # Reuse a graph already compiled for this model, graph type and tool selection,
+            # built from the current MCP tools (the epoch changes when they may be stale)
+            cache_key = (model_name, graph_type, frozenset(enabled_tools or ()), self.mcp_service.epoch)
+            if self._use_cached_agent(cache_key):
+                return True
             
-            self.current_model = model_name
-            self.current_graph_type = graph_type
-            return True
+            # Serialize builds so concurrent callers don't race on self.agent or duplicate work
+            async with self._init_lock:
+                # Another caller may have built this agent while we waited
+                if self._use_cached_agent(cache_key):
+                    return True
+                
+                # Ensure MCP service is initialized
+                if not self.mcp_service.is_initialized():
+                    self.invalidate_agent_cache()
+                    await self.mcp_service.initialize()
+                    cache_key = (model_name, graph_type, frozenset(enabled_tools or ()), self.mcp_service.epoch)
+                
+                # Get filtered tools if enabled_tools is provided, otherwise get all tools
+                tools_task = self.mcp_service.get_filtered_tools(enabled_tools) if enabled_tools else self.mcp_service.get_tools()
+                
+                # Reuse the model (and its connection pool) if it was created before,
+                # otherwise construct it in a thread while the tools are being fetched
+                model = self._model_cache.get(model_name)
+                if model is None:
+                    tools, model = await asyncio.gather(tools_task, asyncio.to_thread(self._create_model, model_name))
+                    self._model_cache[model_name] = model
+                else:
+                    tools = await tools_task
+                
+                if not tools:
+                    return False
+
+                # Create agent based on graph type using graph_service
+                if graph_type == "simple":
+                    # Traditional ReAct agent - fast and simple
+                    self.agent = self.graph_service.create_react_graph(
+                        model=model,
+                        tools=tools,
+                        system_prompt=self.system_prompt,
+                        checkpointer=self.checkpointer
+                    )
+                else:  # extended
+                    # Reflection-based agent - dynamic and thorough
+                    self.agent = self.graph_service.create_reflection_graph(
+                        model=model,
+                        tools=tools,
+                        system_prompt=self.system_prompt
+                    )
+                
+                self.tool_names = [getattr(t, 'name', str(t)) for t in tools]
+                self._agent_cache[cache_key] = (self.agent, self.tool_names)
+                self._agent_key = cache_key
+                if len(self._agent_cache) > self.max_cached_agents:
+                    self._agent_cache.popitem(last=False)
+                
+                self.current_model = model_name
+                self._set_graph_type(graph_type)
+                return True
             
         except Exception as e:
             logger.error(f"Error initializing agent: {str(e)}")
@@ -124,65 +163,279 @@ class AgentService:
         recursion_limit: int = 100,
         callback: Optional[Callable] = None,
         enabled_tools: Optional[List[str]] = None,
+        use_cache: bool = True,
     ) -> Dict[str, Any]:
         """Send message to agent and get response"""
+        return await self.graph_service.deliver_stream(
+            self.chat_stream(
+                message,
+                thread_id=thread_id,
+                timeout_seconds=timeout_seconds,
+                recursion_limit=recursion_limit,
+                enabled_tools=enabled_tools,
+                use_cache=use_cache,
+            ),
+            callback
+        )
+
+    async def chat_stream(
+        self,
+        message: str,
+        thread_id: Optional[str] = None,
+        timeout_seconds: int = 120,
+        recursion_limit: int = 100,
+        enabled_tools: Optional[List[str]] = None,
+        use_cache: bool = True,
+    ) -> AsyncIterator[StreamPayload]:
+        """
+        Send message to agent and yield {"node", "content"} payloads as they stream in;
+        the last payload (node FINAL_RESULT_NODE) carries the chat result
+        """
+        if not thread_id:
+            thread_id = random_uuid()
+
         # Reinitialize agent with filtered tools if enabled_tools is provided
         if enabled_tools is not None:
-            success = await self.initialize_agent(self.current_model or "claude-sonnet-4-20250514", enabled_tools, self.current_graph_type)
+            success = await self.initialize_agent(self.current_model or DEFAULT_MODEL, enabled_tools, self.current_graph_type)
             if not success:
                 raise RuntimeError("Failed to initialize agent with filtered tools")
         elif not self.agent:
             raise RuntimeError("Agent not initialized. Call initialize_agent() first.")
+        elif self._agent_key is not None and self._agent_key[3] != self.mcp_service.epoch:
+            # MCP tools changed (or a server session died) since this agent was built
+            model_name, graph_type, tools, _ = self._agent_key
+            if not await self.initialize_agent(model_name, sorted(tools) or None, graph_type):
+                raise RuntimeError("Failed to rebuild agent with current MCP tools")
 
-        if not thread_id:
-            thread_id = random_uuid()
+        config = RunnableConfig(
+            recursion_limit=recursion_limit,
+            thread_id=thread_id,
+        )
 
-        try:
-            config = RunnableConfig(
-                recursion_limit=recursion_limit,
+        # Cached answers must match the conversation so far: key them on the thread's latest checkpoint
+        cache_key = None
+        embedding = None
+        checkpoint_id = None
+        cache_namespace = (self.current_model, self.current_graph_type, tuple(sorted(enabled_tools or [])), self.system_prompt_version)
+        if use_cache and (self.response_cache.is_enabled() or self.semantic_cache.is_enabled()):
+            try:
+                checkpoint_id = await self._checkpoint_id(thread_id)
+            except Exception as e:
+                logger.warning(f"Skipping response caches, thread state unavailable: {e}")
+                use_cache = False
+
+        # Serve repeated requests from the exact-match cache
+        if use_cache and self.response_cache.is_enabled():
+            cache_key = self.response_cache.make_key(
+                message=message,
+                model=self.current_model,
+                graph_type=self.current_graph_type,
+                tools=sorted(enabled_tools or []),
                 thread_id=thread_id,
+                checkpoint_id=checkpoint_id,
+                system_prompt_version=self.system_prompt_version,
             )
+            cached = await self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Response cache hit for thread {thread_id}")
+                await self._record_cached_turn(thread_id, message, cached)
+                for payload in self._cached_response(cached, thread_id):
+                    yield payload
+                return
 
-            # Prepare input format based on graph type
-            if self.current_graph_type == "simple":
-                agent_input = {"messages": [HumanMessage(content=message)]}
-            else:  # extended
-                # Get tool names synchronously to avoid async issues
-                tools = await self.mcp_service.get_tools()
-                tool_names = [getattr(t, 'name', str(t)) for t in tools]
-                agent_input = {
-                    "messages": [],
-                    "loop_step": 0,
-                    "original_request": message,
-                    "tools_available": tool_names,
-                    "current_progress": "Starting to work on your request...",
-                    "is_complete": False,
-                    "max_loops": 10
-                }
-            
-            # Use graph_service unified streaming
-            logger.info(f"Starting streaming from graph type {self.current_graph_type} with model: {self.current_model}")
-            response = await asyncio.wait_for(
-                self.graph_service.astream_graph(
-                    graph=self.agent,
-                    inputs=agent_input,
-                    config=config,
-                    callback=callback,
-                    graph_type=self.current_graph_type
-                ),
-                timeout=timeout_seconds,
-            )
-            
-            return {
-                "response": response,
-                "thread_id": thread_id,
-                "model_used": self.current_model,
-            }
-            
-        except asyncio.TimeoutError:
+        # Serve paraphrases of recently answered messages from the semantic cache, but only
+        # for requests without earlier context, where the answer can't depend on the thread
+        if use_cache and self.semantic_cache.is_enabled() and checkpoint_id is None:
+            embedding = await self.semantic_cache.embed(message)
+            cached = self.semantic_cache.lookup(cache_namespace, embedding)
+            if cached is not None:
+                logger.info(f"Semantic cache hit for thread {thread_id}")
+                await self._record_cached_turn(thread_id, message, cached)
+                for payload in self._cached_response(cached, thread_id):
+                    yield payload
+                return
+
+        # Input builder for the current graph type, selected when the agent was set
+        agent_input = self._build_input(message)
+        
+        # Use graph_service unified streaming
+        logger.info(f"Starting streaming from graph type {self.current_graph_type} with model: {self.current_model}")
+        stream = self.graph_service.astream_graph_iter(
+            graph=self.agent,
+            inputs=agent_input,
+            config=config,
+            graph_type=self.current_graph_type
+        )
+        
+        # The deadline only bounds waiting on the graph, never a suspended yield to the consumer
+        deadline = asyncio.get_running_loop().time() + timeout_seconds
+        response = {}
+        used_tools = False
+        try:
+            while True:
+                async with asyncio.timeout_at(deadline):
+                    payload = await anext(stream, None)
+                if payload is None:
+                    break
+                if payload.node == FINAL_RESULT_NODE:
+                    response = payload.content
+                else:
+                    used_tools = used_tools or payload.node in ("tools", "tool_args")
+                    yield payload
+        except TimeoutError:
             raise RuntimeError(f"Request timed out after {timeout_seconds} seconds")
         except Exception as e:
             raise RuntimeError(f"Error during chat: {str(e)}")
+        finally:
+            await stream.aclose()
+        
+        # Answers built from tool results (time, weather, files) go stale, so only cache tool-free ones
+        collected_content = response.get("collected_content")
+        if collected_content and not used_tools:
+            if cache_key is not None:
+                await self.response_cache.set(cache_key, collected_content)
+            if embedding is not None:
+                self.semantic_cache.store(cache_namespace, embedding, collected_content)
+        
+        yield StreamPayload(FINAL_RESULT_NODE, {
+            "response": response,
+            "thread_id": thread_id,
+            "model_used": self.current_model,
+        })
+
+    def _cached_response(self, content: str, thread_id: str) -> List[StreamPayload]:
+        """Build stream payloads for cached content: a single agent chunk and the final result"""
+        return [
+            StreamPayload("agent", AIMessage(content=content)),
+            StreamPayload(FINAL_RESULT_NODE, {
+                "response": {"collected_content": content},
+                "thread_id": thread_id,
+                "model_used": self.current_model,
+            }),
+        ]
+
+    async def _checkpoint_id(self, thread_id: str) -> Optional[str]:
+        """Get the id of the thread's latest checkpoint, or None if the thread has no history"""
+        if getattr(self.agent, "checkpointer", None) is None:
+            return None  # Graphs without a checkpointer keep no history between turns
+        state = await self.agent.aget_state({"configurable": {"thread_id": thread_id}})
+        if not state.values:
+            return None
+        return state.config.get("configurable", {}).get("checkpoint_id")
+
+    async def _record_cached_turn(self, thread_id: str, message: str, content: str):
+        """Write a turn answered from cache into the thread's history, as if the agent had answered it"""
+        if getattr(self.agent, "checkpointer", None) is None:
+            return
+        try:
+            await self.agent.aupdate_state(
+                {"configurable": {"thread_id": thread_id}},
+                {"messages": [HumanMessage(content=message), AIMessage(content=content)]},
+                as_node="agent",
+            )
+        except Exception as e:
+            logger.warning(f"Failed to record cached turn for thread {thread_id}: {e}")
+
+    async def setup_checkpointer(self, db_path: Optional[str] = None) -> bool:
+        """Switch to persistent SQLite checkpoints (WAL mode); call before building agents"""
+        if not SQLITE_CHECKPOINT_SUPPORT:
+            logger.info("langgraph-checkpoint-sqlite not installed. Using in-memory checkpoints.")
+            return False
+        
+        db_path = db_path or os.environ.get("CHECKPOINT_DB", "agent_checkpoints.db")
+        try:
+            conn = await aiosqlite.connect(db_path)
+            # WAL lets checkpoint reads proceed alongside writes
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            checkpointer = AsyncSqliteSaver(conn)
+            await checkpointer.setup()
+        except Exception as e:
+            logger.error(f"Error opening checkpoint database {db_path}: {str(e)}")
+            return False
+        
+        self._checkpoint_conn = conn
+        self.checkpointer = checkpointer
+        self.invalidate_agent_cache()  # Cached graphs hold the old checkpointer
+        return True
+
+    def _simple_input(self, message: str) -> Dict[str, Any]:
+        """Build input for the ReAct graph"""
+        return {"messages": [HumanMessage(content=message)]}
+
+    def _extended_input(self, message: str) -> Dict[str, Any]:
+        """Build input for the reflection graph"""
+        return {
+            "messages": [],
+            "loop_step": 0,
+            "original_request": message,
+            "tools_available": self.tool_names,
+            "current_progress": ["Starting to work on your request..."],
+            "work_log": [],
+            "tool_call_counts": {},
+            "is_complete": False,
+            "max_loops": 10
+        }
+
+    def _set_graph_type(self, graph_type: str):
+        """Record the current graph type and pick its input builder"""
+        self.current_graph_type = graph_type
+        self._build_input = self._simple_input if graph_type == "simple" else self._extended_input
+
+    def _use_cached_agent(self, cache_key: tuple) -> bool:
+        """Switch to a cached compiled agent if one exists for the key"""
+        cached_agent = self._agent_cache.get(cache_key)
+        if cached_agent is None or not self.mcp_service.is_initialized():
+            return False
+        self._agent_cache.move_to_end(cache_key)
+        self.agent, self.tool_names = cached_agent
+        self._agent_key = cache_key
+        self.current_model = cache_key[0]
+        self._set_graph_type(cache_key[1])
+        return True
+
+    def invalidate_agent_cache(self):
+        """Drop compiled graphs, e.g. after the MCP tool configuration changed"""
+        self._agent_cache.clear()
+
+    def _create_model(self, model_name: str) -> BaseChatModel:
+        """Construct a chat model from the registry"""
+        spec = MODEL_REGISTRY.get(model_name)
+        if spec is None:
+            raise ValueError(f"Unsupported model: {model_name}")
+        
+        kwargs: Dict[str, Any] = {}
+        if spec["http_client_arg"]:
+            kwargs[spec["http_client_arg"]] = self._get_http_client()
+        
+        return spec["provider"](
+            model=model_name,
+            temperature=0.1,
+            max_tokens=spec["max_tokens"],
+            **kwargs,
+        )
+
+    def _get_http_client(self) -> httpx.AsyncClient:
+        """Get the shared HTTP client for model API calls"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+        return self._http_client
+
+    async def cleanup(self):
+        """Release cache, HTTP and checkpoint database connections"""
+        await self.response_cache.close()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+        self._model_cache.clear()
+        self._agent_cache.clear()
+        if self._checkpoint_conn is not None:
+            await self._checkpoint_conn.close()
+            self._checkpoint_conn = None
 
     def is_initialized(self) -> bool:
         """Check if agent is properly initialized"""
@@ -190,9 +443,11 @@ class AgentService:
 
     async def get_status(self) -> Dict[str, Any]:
         """Get agent status information"""
+        initialized = self.is_initialized()
         return {
-            "initialized": self.is_initialized(),
-            "tool_count": await self.mcp_service.get_tool_count(),
-            "model": self.current_model or "claude-sonnet-4-20250514",
+            "initialized": initialized,
+            # Skip the MCP round-trip when there is no agent to report tools for
+            "tool_count": await self.mcp_service.get_tool_count() if initialized else 0,
+            "model": self.current_model or DEFAULT_MODEL,
             "available_models": self.get_available_models(),
         }
\ No newline at end of file
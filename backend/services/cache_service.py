@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+# Optional: Redis for exact-match response caching
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Optional: Local embedding model for semantic caching
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    SEMANTIC_CACHE_AVAILABLE = True
+except ImportError:
+    SEMANTIC_CACHE_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Redis cache for responses to byte-identical chat requests"""
+
+    KEY_PREFIX = "agent:"
+
+    def __init__(self, redis_url: Optional[str] = None, ttl_seconds: int = 600):
+        self.ttl_seconds = ttl_seconds
+        self._redis = aioredis.from_url(redis_url) if REDIS_AVAILABLE and redis_url else None
+
+        if redis_url and not REDIS_AVAILABLE:
+            logger.warning("redis not installed. Response cache disabled.")
+
+    def is_enabled(self) -> bool:
+        """Check if a Redis connection is configured"""
+        return self._redis is not None
+
+    def make_key(self, **parts: Any) -> str:
+        """Hash a canonical JSON encoding of the request parts into a cache key"""
+        canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return self.KEY_PREFIX + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Get a cached response, treating Redis errors as misses"""
+        try:
+            cached = await self._redis.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        return json.loads(cached) if cached else None
+
+    async def set(self, key: str, response: str):
+        """Cache a response, ignoring Redis errors"""
+        try:
+            await self._redis.set(key, json.dumps(response), ex=self.ttl_seconds)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {e}")
+
+    async def close(self):
+        """Close the Redis connection"""
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+
+class SemanticCache:
+    """Response cache that matches paraphrased messages by embedding similarity"""
+
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        threshold: float = 0.92,
+        ttl_seconds: int = 3600,
+        max_entries: int = 1000,
+        max_namespaces: int = 64,
+    ):
+        self.model_name = model_name
+        self.threshold = threshold            # Minimum cosine similarity for a hit
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries        # Per namespace, oldest evicted first
+        self.max_namespaces = max_namespaces  # Least recently used namespace evicted first
+        self._model = None                    # Loaded on first use
+        self._entries: OrderedDict[Hashable, List[Tuple[float, "np.ndarray", str]]] = OrderedDict()
+
+        if model_name and not SEMANTIC_CACHE_AVAILABLE:
+            logger.warning("sentence-transformers not installed. Semantic cache disabled.")
+
+    def is_enabled(self) -> bool:
+        """Check if an embedding model is configured and available"""
+        return SEMANTIC_CACHE_AVAILABLE and bool(self.model_name)
+
+    def _embed(self, text: str) -> "np.ndarray":
+        """Embed text as a unit vector (blocking)"""
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(text, normalize_embeddings=True)
+
+    async def embed(self, text: str) -> "np.ndarray":
+        """Embed text without stalling the event loop"""
+        return await asyncio.to_thread(self._embed, text)
+
+    def lookup(self, namespace: Hashable, embedding: "np.ndarray") -> Optional[str]:
+        """Get the cached response most similar to the embedding, if similar enough"""
+        entries = self._entries.get(namespace)
+        if not entries:
+            return None
+        self._entries.move_to_end(namespace)
+
+        # Drop expired entries
+        now = time.monotonic()
+        entries[:] = [entry for entry in entries if now - entry[0] < self.ttl_seconds]
+        if not entries:
+            return None
+
+        # Embeddings are normalized, so the dot product is the cosine similarity
+        scores = np.stack([entry[1] for entry in entries]) @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return entries[best][2]
+        return None
+
+    def store(self, namespace: Hashable, embedding: "np.ndarray", response: str):
+        """Cache a response under the message embedding"""
+        entries = self._entries.setdefault(namespace, [])
+        self._entries.move_to_end(namespace)
+        entries.append((time.monotonic(), embedding, response))
+        if len(entries) > self.max_entries:
+            del entries[0]
+        if len(self._entries) > self.max_namespaces:
+            self._entries.popitem(last=False)
@@ -1,17 +1,41 @@
+import asyncio
+import copy
 import json
 import os
 import re
-from typing import Dict, Any
+import tempfile
+from collections import deque
 from pathlib import Path
-import sys
-import os
-sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from typing import Dict, Any
+
+from pydantic import TypeAdapter
+
 from models import ToolConfig
 
+# Optional: Faster JSON parsing/serialization
+try:
+    import orjson
+    ORJSON_SUPPORT = True
+except ImportError:
+    ORJSON_SUPPORT = False
+
+# Optional: Non-blocking file I/O (falls back to a worker thread)
+try:
+    import aiofiles
+    AIOFILES_SUPPORT = True
+except ImportError:
+    AIOFILES_SUPPORT = False
+
+
+# Validates a whole {tool_name: ToolConfig} mapping in one pydantic-core call
+_TOOLS_ADAPTER = TypeAdapter(Dict[str, ToolConfig])
+
 
 class ConfigService:
     def __init__(self, config_file: str = "config.json"):
         self.config_file = Path(config_file)
+        self._cache: Dict[str, Any] | None = None  # Raw parsed config, before env substitution
+        self._cache_mtime_ns: int = -1
         self.default_config = {
             "get_current_time": {
                 "command": "python", 
@@ -23,17 +47,77 @@ class ConfigService:
     def load_config(self) -> Dict[str, Any]:
         """Load MCP configuration from JSON file with environment variable substitution"""
         try:
-            if self.config_file.exists():
-                with open(self.config_file, "r", encoding="utf-8") as f:
-                    config = json.load(f)
-                    return self._substitute_env_vars(config)
-            else:
+            try:
+                mtime_ns = os.stat(self.config_file).st_mtime_ns
+            except FileNotFoundError:
                 # Create file with default config if it doesn't exist
                 self.save_config(self.default_config)
                 return self.default_config
+            
+            # Only re-read the file when it changed; substitution builds a fresh copy for the caller
+            if self._cache is None or mtime_ns != self._cache_mtime_ns:
+                with open(self.config_file, "rb") as f:
+                    self._cache = self._loads(f.read())
+                self._cache_mtime_ns = mtime_ns
+            return self._substitute_env_vars(self._cache)
         except Exception as e:
             raise RuntimeError(f"Error loading config file: {str(e)}")
     
+    async def aload_config(self) -> Dict[str, Any]:
+        """Load MCP configuration without blocking the event loop"""
+        try:
+            try:
+                mtime_ns = os.stat(self.config_file).st_mtime_ns
+            except FileNotFoundError:
+                # Create file with default config if it doesn't exist
+                await self.asave_config(self.default_config)
+                return self.default_config
+            
+            # Only re-read the file when it changed; substitution builds a fresh copy for the caller
+            if self._cache is None or mtime_ns != self._cache_mtime_ns:
+                self._cache = self._loads(await self._read_bytes())
+                self._cache_mtime_ns = mtime_ns
+            return self._substitute_env_vars(self._cache)
+        except Exception as e:
+            raise RuntimeError(f"Error loading config file: {str(e)}")
+    
+    async def _read_bytes(self) -> bytes:
+        """Read the config file asynchronously"""
+        if AIOFILES_SUPPORT:
+            async with aiofiles.open(self.config_file, "rb") as f:
+                return await f.read()
+        return await asyncio.to_thread(self.config_file.read_bytes)
+    
+    def _write_atomic(self, data: bytes):
+        """Write the config file via a synced temp file and rename, so readers never see a partial file"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.config_file.parent, prefix=f".{self.config_file.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.config_file)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    
+    @staticmethod
+    def _loads(data: bytes) -> Dict[str, Any]:
+        """Parse config JSON"""
+        if ORJSON_SUPPORT:
+            return orjson.loads(data)
+        return json.loads(data)
+    
+    @staticmethod
+    def _dumps(config: Dict[str, Any]) -> bytes:
+        """Serialize config as indented UTF-8 JSON"""
+        if ORJSON_SUPPORT:
+            return orjson.dumps(config, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        return json.dumps(config, indent=2, ensure_ascii=False).encode("utf-8")
+    
     def _substitute_env_vars(self, config: Dict[str, Any]) -> Dict[str, Any]:
         """Recursively substitute environment variables in config"""
         
@@ -54,39 +138,45 @@ class ConfigService:
         
         return substitute_value(config)
     
+    @staticmethod
+    def _is_tool_config(value: Any) -> bool:
+        """Check if a value looks like a single tool configuration"""
+        return isinstance(value, dict) and ("command" in value or "url" in value)
+
     def extract_tool_config(self, raw_config: dict[str, Any], tool_name: str | None = None) -> dict[str, Any]:
         """Smart extraction of tool configuration from various nested formats"""
         
         # Format 1: Direct tool config {"command": "...", "args": [...], ...}
-        if "command" in raw_config or "url" in raw_config:
+        if self._is_tool_config(raw_config):
             return raw_config
         
-        # Format 2: mcpServers wrapper {"mcpServers": {"tool-name": {...}}}
-        if "mcpServers" in raw_config:
-            servers = raw_config["mcpServers"]
+        # Search nested levels breadth-first, without recursion
+        queue = deque([raw_config])
+        seen = set()
+        while queue:
+            current = queue.popleft()
+            if id(current) in seen:
+                continue
+            seen.add(id(current))
+            
+            # Format 2: mcpServers wrapper {"mcpServers": {"tool-name": {...}}}
+            servers = current.get("mcpServers")
             if isinstance(servers, dict):
                 # If tool_name provided, try to find specific server
                 if tool_name and tool_name in servers:
                     return servers[tool_name]
                 # Otherwise, take the first server config
                 for server_config in servers.values():
-                    if isinstance(server_config, dict) and ("command" in server_config or "url" in server_config):
+                    if self._is_tool_config(server_config):
                         return server_config
-        
-        # Format 3: Single server key {"server-name": {"command": "...", ...}}
-        for key, value in raw_config.items():
-            if isinstance(value, dict) and ("command" in value or "url" in value):
-                return value
-        
-        # Format 4: Nested structure - recursively search for tool config
-        for key, value in raw_config.items():
-            if isinstance(value, dict):
-                try:
-                    result = self.extract_tool_config(value, tool_name)
-                    if result != value:  # Found something different (extracted)
-                        return result
-                except Exception:
-                    continue
+            
+            # Format 3: Single server key {"server-name": {"command": "...", ...}}
+            for value in current.values():
+                if self._is_tool_config(value):
+                    return value
+            
+            # Format 4: Nested structure - search the next level
+            queue.extend(value for value in current.values() if isinstance(value, dict))
         
         # Could not extract, return original
         return raw_config
@@ -94,8 +184,20 @@ class ConfigService:
     def save_config(self, config: Dict[str, Any]) -> bool:
         """Save MCP configuration to JSON file"""
         try:
-            with open(self.config_file, "w", encoding="utf-8") as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
+            self._write_atomic(self._dumps(config))
+            self._cache = copy.deepcopy(config)
+            self._cache_mtime_ns = os.stat(self.config_file).st_mtime_ns
+            return True
+        except Exception as e:
+            raise RuntimeError(f"Error saving config file: {str(e)}")
+
+    async def asave_config(self, config: Dict[str, Any]) -> bool:
+        """Save MCP configuration without blocking the event loop"""
+        try:
+            # Write and fsync off the event loop
+            await asyncio.to_thread(self._write_atomic, self._dumps(config))
+            self._cache = copy.deepcopy(config)
+            self._cache_mtime_ns = os.stat(self.config_file).st_mtime_ns
             return True
         except Exception as e:
             raise RuntimeError(f"Error saving config file: {str(e)}")
@@ -115,48 +217,71 @@ class ConfigService:
             self.save_config(config)
         return config
 
+    async def aadd_tool(self, tool_name: str, tool_config: ToolConfig) -> Dict[str, Any]:
+        """Add a new tool to configuration without blocking the event loop"""
+        config = await self.aload_config()
+        config[tool_name] = tool_config.model_dump(exclude_none=True)
+        await self.asave_config(config)
+        return config
+
+    async def aremove_tool(self, tool_name: str) -> Dict[str, Any]:
+        """Remove a tool from configuration without blocking the event loop"""
+        config = await self.aload_config()
+        if tool_name in config:
+            del config[tool_name]
+            await self.asave_config(config)
+        return config
+
     def validate_tool_config(self, tool_config: ToolConfig) -> bool:
         """Validate tool configuration"""
         
-        # Check required fields
-        if not tool_config.command and not tool_config.url:
-            raise ValueError(
-                f"Tool configuration requires either 'command' or 'url' field. "
-                f"Received: command='{tool_config.command}', url='{tool_config.url}'"
-            )
-        
-        if tool_config.command and not tool_config.args:
-            raise ValueError(
-                f"Tool configuration with 'command' requires 'args' field. "
-                f"Received command='{tool_config.command}' but args={tool_config.args}"
-            )
+        command, url, args, transport = tool_config.command, tool_config.url, tool_config.args, tool_config.transport
         
-        if tool_config.command and not isinstance(tool_config.args, list):
-            raise ValueError(
-                f"'args' field must be a list. "
-                f"Received args={tool_config.args} (type: {type(tool_config.args).__name__})"
-            )
+        # Check required fields
+        match (bool(command), bool(url)):
+            case (False, False):
+                raise ValueError(
+                    f"Tool configuration requires either 'command' or 'url' field. "
+                    f"Received: command='{command}', url='{url}'"
+                )
+            case (True, _) if not args:
+                raise ValueError(
+                    f"Tool configuration with 'command' requires 'args' field. "
+                    f"Received command='{command}' but args={args}"
+                )
+            case (True, _) if not isinstance(args, list):
+                raise ValueError(
+                    f"'args' field must be a list. "
+                    f"Received args={args} (type: {type(args).__name__})"
+                )
         
-        # Set default transport based on configuration
-        if tool_config.url and not tool_config.transport:
-            tool_config.transport = "http"  # Default to http for URL-based configs
-        elif not tool_config.transport:
-            tool_config.transport = "stdio"
-            
-        # Validate HTTP transport requirements
-        if tool_config.transport == "http" and not tool_config.url:
-            raise ValueError(
-                f"HTTP transport requires 'url' field. "
-                f"Received transport='http' but url='{tool_config.url}'"
-            )
+        # Set default transport based on configuration, then validate HTTP transport requirements
+        match (bool(url), transport or None):
+            case (True, None):
+                tool_config.transport = "http"  # Default to http for URL-based configs
+            case (False, None):
+                tool_config.transport = "stdio"
+            case (False, "http"):
+                raise ValueError(
+                    f"HTTP transport requires 'url' field. "
+                    f"Received transport='http' but url='{url}'"
+                )
         return True
 
     def update_config(self, new_config: Dict[str, Any]) -> Dict[str, Any]:
         """Replace entire configuration"""
         # Validate all tools in new config
-        for tool_name, tool_data in new_config.items():
-            tool_config = ToolConfig(**tool_data)
+        for tool_config in _TOOLS_ADAPTER.validate_python(new_config).values():
             self.validate_tool_config(tool_config)
         
         self.save_config(new_config)
-        return new_config
\ No newline at end of file
+        return new_config
+
+    async def aupdate_config(self, new_config: Dict[str, Any]) -> Dict[str, Any]:
+        """Replace entire configuration without blocking the event loop"""
+        # Validate all tools in new config
+        for tool_config in _TOOLS_ADAPTER.validate_python(new_config).values():
+            self.validate_tool_config(tool_config)
+        
+        await self.asave_config(new_config)
+        return new_config
@@ -1,16 +1,45 @@
+import hashlib
 import json
 import logging
 import asyncio
-from typing import Any, Dict, List, Optional, TypedDict, Sequence, Literal, Callable
+import operator
+import re
+import string
+from collections import OrderedDict
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional, TypedDict, Sequence, Literal, Callable, Tuple
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage, ToolMessage
 from langchain_core.runnables import Runnable, RunnableConfig
 from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import create_react_agent
-from .streaming_service import StreamingService
+from .streaming_service import StreamingService, StreamPayload
 
 logger = logging.getLogger(__name__)
 
+# Node name of the last payload from a stream, whose content is the final result
+FINAL_RESULT_NODE = "final_result"
+
+# Configurable key carrying a run's stream callback to graph nodes
+STREAM_CALLBACK_KEY = "stream_callback"
+
+# Reflection verdict prefix and the summary or feedback that follows it
+_VERDICT_RE = re.compile(r"(COMPLETE|CONTINUE):\s*(.*)", re.S)
+
+
+def _compile_template(template: str) -> Callable[..., str]:
+    """Split a str.format template into literals and field names once, returning a fast renderer"""
+    parts = []
+    for literal, field_name, _, _ in string.Formatter().parse(template):
+        if literal:
+            parts.append((literal, None))
+        if field_name is not None:
+            parts.append((None, field_name))
+    
+    def render(**fields: str) -> str:
+        return "".join(literal if field_name is None else fields[field_name] for literal, field_name in parts)
+    
+    return render
+
 
 class ReflectionState(TypedDict):
     """State for Reflection-based agent"""
@@ -18,17 +47,37 @@ class ReflectionState(TypedDict):
     loop_step: int               # Current iteration count
     original_request: str        # The user's original request
     tools_available: List[str]   # Available MCP tools
-    current_progress: str        # What we've accomplished so far
+    current_progress: Annotated[List[str], operator.add]  # What we've accomplished so far (append-only)
+    work_log: Annotated[List[str], operator.add]  # One entry per agent reply or tool result (append-only)
     is_complete: bool           # Whether we're done
+    route: str                  # Next step decided by the agent node: "continue", "tools", "reflect" or "end"
+    pending_tool_calls: List[Dict[str, Any]]  # Agent tool calls to execute (those before any Complete call)
+    tool_call_counts: Dict[str, int]  # Calls made per (name, canonical args) signature, for loop detection
     max_loops: int              # Maximum number of loops
 
 
 class GraphService:
     """Service for creating and managing both ReAct and Reflection graphs with unified streaming"""
     
-    def __init__(self):
-        self.current_callback = None  # Store callback for tool nodes to access
-        self.streaming_service = StreamingService()  # Centralized streaming handler
+    # Most recent progress (in characters) included in the agent prompt
+    PROGRESS_CHAR_BUDGET = 20000
+    
+    # Most recent work log (in characters) included in the reflection prompt
+    WORK_SUMMARY_CHAR_BUDGET = 16000
+    
+    # Payloads buffered for an async stream callback before the producer waits for it
+    CALLBACK_QUEUE_SIZE = 256
+    
+    # Identical (name, args) tool calls after which the reflection graph stops as looping
+    TOOL_LOOP_THRESHOLD = 5
+    
+    # Reflection verdicts kept in the LRU cache
+    MAX_REFLECTION_CACHE = 256
+    
+    def __init__(self, enable_reflection_cache: bool = True):
+        self.enable_reflection_cache = enable_reflection_cache
+        # Prompt hash -> (is_complete, summary or feedback), most recently used last
+        self._reflection_cache: OrderedDict[str, Tuple[bool, str]] = OrderedDict()
         self.agent_prompt = """You are helping a user accomplish their request using available tools.
 
 USER REQUEST: {original_request}
@@ -70,18 +119,21 @@ Return either:
     ) -> CompiledStateGraph:
         """Create a Reflection-based agent graph"""
         
+        # Tools and model are fixed for this graph: bind tool schemas and build lookups once
+        tools_by_name = {getattr(tool, 'name', str(tool)): tool for tool in tools}
+        tool_names_str = ", ".join([*tools_by_name, "Complete"])  # Include our completion tool
+        model_with_tools = model.bind_tools(self._create_enhanced_tools(tools))
+        render_agent_prompt = _compile_template(self.agent_prompt)
+        render_reflection_prompt = _compile_template(self.reflection_prompt)
+        
         async def agent_node(state: ReflectionState) -> Dict[str, Any]:
             """Main agent node - chooses and executes tools"""
             try:
-                # Get tool names for the prompt
-                tool_names = [getattr(tool, 'name', str(tool)) for tool in tools]
-                tool_names.append("Complete")  # Add our completion tool
-                
                 # Build the agent prompt
-                agent_message = self.agent_prompt.format(
-                    tools=", ".join(tool_names),
+                agent_message = render_agent_prompt(
+                    tools=tool_names_str,
                     original_request=state["original_request"],
-                    current_progress=state["current_progress"]
+                    current_progress=self._join_recent(state["current_progress"], self.PROGRESS_CHAR_BUDGET)
                 )
                 
                 # Prepare messages - just system prompt and current request
@@ -91,29 +143,61 @@ Return either:
                     messages.append(SystemMessage(content=system_prompt))
                 messages.append(HumanMessage(content=agent_message))
                 
-                # Create model with tools (including our Complete tool)
-                enhanced_tools = self._create_enhanced_tools(tools)
-                model_with_tools = model.bind_tools(enhanced_tools)
-                
-                # Get response
-                response = await model_with_tools.ainvoke(messages)
+                # Stream the response (model is bound with our Complete tool too) so tokens
+                # reach stream_mode="messages" as they arrive, aggregating chunks into one message
+                response = None
+                async for chunk in model_with_tools.astream(messages):
+                    response = chunk if response is None else response + chunk
+                if response is None:
+                    response = AIMessage(content="")
                 
                 # Check if agent called Complete tool
-                is_complete = False
+                tool_calls = getattr(response, 'tool_calls', None) or []
+                complete_idx = next(
+                    (i for i, tool_call in enumerate(tool_calls) if tool_call.get('name') == 'Complete'), -1
+                )
+                is_complete = complete_idx >= 0
+                if is_complete:
+                    tool_calls = tool_calls[:complete_idx]  # Calls after Complete are discarded
+                
+                # Count calls by their final args; a model repeating the same call is stuck in a loop
+                tool_call_counts = dict(state.get("tool_call_counts") or {})
+                looping = False
+                for tool_call in tool_calls:
+                    signature = json.dumps(
+                        [tool_call.get('name'), tool_call.get('args', {})],
+                        sort_keys=True, separators=(",", ":"), default=str
+                    )
+                    tool_call_counts[signature] = tool_call_counts.get(signature, 0) + 1
+                    if tool_call_counts[signature] >= self.TOOL_LOOP_THRESHOLD:
+                        looping = True
+                if looping:
+                    logger.warning(f"Stopping agent: repeated identical tool calls ({self.TOOL_LOOP_THRESHOLD}+ times)")
+                    tool_calls = []
                 
-                if hasattr(response, 'tool_calls') and response.tool_calls:
-                    for tool_call in response.tool_calls:
-                        if tool_call.get('name') == 'Complete':
-                            is_complete = True
-                            break
+                # Decide the next step here so the router is a single state read
+                loop_step = state["loop_step"] + 1
+                if is_complete or looping or loop_step >= state.get("max_loops", 10):
+                    route = "end"
+                elif tool_calls:
+                    route = "tools"
+                elif loop_step % 3 == 0:
+                    route = "reflect"  # Reflect every few loops
+                else:
+                    route = "continue"
                 
-                logger.info(f"Agent loop {state['loop_step'] + 1}: {'Completing' if is_complete else 'Continuing'}")
+                logger.info(f"Agent loop {loop_step}: {'Completing' if is_complete else 'Continuing'}")
+                
+                text = StreamingService.content_text(response.content)
                 
                 return {
+                    "work_log": [f"Agent: {text}"] if text else [],
                     "messages": [response],  # Keep the agent response for conversation history
-                    "loop_step": state["loop_step"] + 1,
+                    "loop_step": loop_step,
                     "is_complete": is_complete,
-                    "current_progress": state["current_progress"]
+                    "route": route,
+                    "pending_tool_calls": tool_calls,
+                    "tool_call_counts": tool_call_counts
                 }
                 
             except Exception as e:
@@ -121,107 +205,115 @@ Return either:
                 return {
                     "messages": [AIMessage(content=f"Error: {str(e)}")],
                     "loop_step": state["loop_step"] + 1,
-                    "is_complete": True  # Stop on error
+                    "is_complete": True,  # Stop on error
+                    "route": "end"
                 }
         
-        async def tool_node(state: ReflectionState) -> Dict[str, Any]:
+        async def run_tool_call(tool_call: Dict[str, Any], callback: Optional[Callable]) -> Optional[ToolMessage]:
+            """Execute one regular tool call"""
+            tool = tools_by_name.get(tool_call.get('name'))
+            if not tool:
+                return None
+            
+            # Log the actual tool call arguments that are being executed
+            tool_args = tool_call.get('args', {})
+            logger.info(f"Executing tool '{tool_call.get('name')}' with args: {tool_args}")
+            
+            # Send real tool args via callback if available
+            if callback and tool_args:
+                try:
+                    result = callback(StreamPayload("tool_args", {
+                        "tool_call_id": tool_call.get('id'),
+                        "tool_name": tool_call.get('name'),
+                        "args": tool_args
+                    }))
+                    if hasattr(result, "__await__"):
+                        await result
+                except Exception as e:
+                    logger.error(f"Error sending tool args via callback: {e}")
+            
+            result = await tool.ainvoke(tool_args)
+            return ToolMessage(
+                content=str(result),
+                tool_call_id=tool_call.get('id', 'unknown'),
+                name=tool_call.get('name', 'unknown')
+            )
+        
+        async def tool_node(state: ReflectionState, config: RunnableConfig) -> Dict[str, Any]:
             """Execute tool calls"""
-            last_message = state["messages"][-1]
-            tool_results = []
+            # Per-run stream callback, so concurrent runs of this graph don't share one
+            callback = config.get("configurable", {}).get(STREAM_CALLBACK_KEY)
             
-            if hasattr(last_message, 'tool_calls') and last_message.tool_calls:
-                for tool_call in last_message.tool_calls:
-                    if tool_call.get('name') == 'Complete':
-                        # Handle completion
-                        tool_results.append(
-                            ToolMessage(
-                                content="Task completed",
-                                tool_call_id=tool_call.get('id', 'complete'),
-                                name='Complete'
-                            )
-                        )
-                        continue
-                    
-                    # Execute regular tools
-                    try:
-                        tool = next((t for t in tools if getattr(t, 'name', str(t)) == tool_call.get('name')), None)
-                        if tool:
-                            # Log the actual tool call arguments that are being executed
-                            tool_args = tool_call.get('args', {})
-                            logger.info(f"Executing tool '{tool_call.get('name')}' with args: {tool_args}")
-                            
-                            # Send real tool args via callback if available
-                            if self.current_callback and tool_args:
-                                try:
-                                    result = self.current_callback({
-                                        "node": "tool_args",
-                                        "content": {
-                                            "tool_call_id": tool_call.get('id'),
-                                            "tool_name": tool_call.get('name'),
-                                            "args": tool_args
-                                        }
-                                    })
-                                    if hasattr(result, "__await__"):
-                                        await result
-                                except Exception as e:
-                                    logger.error(f"Error sending tool args via callback: {e}")
-                            
-                            result = await tool.ainvoke(tool_args)
-                            tool_results.append(
-                                ToolMessage(
-                                    content=str(result),
-                                    tool_call_id=tool_call.get('id', 'unknown'),
-                                    name=tool_call.get('name', 'unknown')
-                                )
-                            )
-                    except Exception as e:
-                        tool_results.append(
-                            ToolMessage(
-                                content=f"Error: {str(e)}",
-                                tool_call_id=tool_call.get('id', 'error'),
-                                name=tool_call.get('name', 'error')
-                            )
+            # The agent node already split off any Complete call
+            tool_calls = state.get("pending_tool_calls") or []
+            
+            # Run all tool calls concurrently; results come back in call order
+            outcomes = await asyncio.gather(
+                *(run_tool_call(tool_call, callback) for tool_call in tool_calls),
+                return_exceptions=True
+            )
+            
+            tool_results = []
+            for tool_call, outcome in zip(tool_calls, outcomes):
+                if isinstance(outcome, Exception):
+                    tool_results.append(
+                        ToolMessage(
+                            content=f"Error: {str(outcome)}",
+                            tool_call_id=tool_call.get('id', 'error'),
+                            name=tool_call.get('name', 'error')
                         )
+                    )
+                elif outcome is not None:
+                    tool_results.append(outcome)
             
             # Update progress based on tool results
-            progress_update = self._extract_progress(tool_results, state["current_progress"])
+            progress_update = self._extract_progress(tool_results)
             
             return {
                 "messages": tool_results,  # Keep tool results for conversation history
-                "current_progress": progress_update
+                "current_progress": progress_update,
+                "work_log": [f"Tool {result.name}: {result.content}" for result in tool_results]
             }
         
         async def reflection_node(state: ReflectionState) -> Dict[str, Any]:
             """Evaluate if work is complete"""
             try:
-                # Extract work completed from messages
-                work_completed = self._extract_work_summary(state["messages"])
+                # Summarize the most recent work logged by the agent and tool nodes
+                work_completed = self._join_recent(state.get("work_log", []), self.WORK_SUMMARY_CHAR_BUDGET)
                 
-                reflection_message = self.reflection_prompt.format(
+                reflection_message = render_reflection_prompt(
                     original_request=state["original_request"],
                     work_completed=work_completed
                 )
                 
-                messages = [HumanMessage(content=reflection_message)]
-                response = await model.ainvoke(messages)
-                content = response.content if hasattr(response, 'content') else str(response)
-                
-                # Parse reflection response
-                is_complete = content.startswith("COMPLETE:")
+                verdict = self._cached_reflection(reflection_message)
+                if verdict is None:
+                    messages = [HumanMessage(content=reflection_message)]
+                    response = await model.ainvoke(messages)
+                    content = response.content if hasattr(response, 'content') else str(response)
+                    
+                    # Parse reflection response (only the leading prefix, not the whole text)
+                    match = _VERDICT_RE.match(content)
+                    if match:
+                        verdict = (match.group(1) == "COMPLETE", match.group(2).strip())
+                    else:
+                        verdict = (False, content.strip())
+                    self._cache_reflection(reflection_message, verdict)
                 
+                is_complete, text = verdict
                 if is_complete:
-                    summary = content.replace("COMPLETE:", "").strip()
+                    summary = text
                     return {
                         "messages": [AIMessage(content=summary)],
                         "is_complete": True,
-                        "current_progress": summary
+                        "current_progress": [summary]
                     }
                 else:
-                    feedback = content.replace("CONTINUE:", "").strip()
+                    feedback = text
                     return {
                         "messages": [AIMessage(content=f"Need to continue: {feedback}")],
                         "is_complete": False,
-                        "current_progress": state["current_progress"] + f"\nNext: {feedback}"
+                        "current_progress": [f"Next: {feedback}"]
                     }
                     
             except Exception as e:
@@ -229,31 +321,8 @@ Return either:
                 return {"is_complete": True}  # Stop on error
         
         def should_continue(state: ReflectionState) -> Literal["continue", "reflect", "tools", "end"]:
-            """Route based on current state"""
-            last_message = state["messages"][-1]
-            
-            # Check loop limits
-            if state["loop_step"] >= state.get("max_loops", 10):
-                return "end"
-            
-            # Check if we're complete
-            if state.get("is_complete", False):
-                return "end"
-            
-            # If last message has tool calls, go to tools
-            if hasattr(last_message, 'tool_calls') and last_message.tool_calls:
-                # Check if it's a Complete call
-                for tool_call in last_message.tool_calls:
-                    if tool_call.get('name') == 'Complete':
-                        return "end"
-                return "tools"
-            
-            # If we've done several loops, reflect
-            if state["loop_step"] > 0 and state["loop_step"] % 3 == 0:
-                return "reflect"
-            
-            # Otherwise continue with agent
-            return "continue"
+            """Route to the step the agent node chose"""
+            return state["route"]
         
         # Build the graph
         workflow = StateGraph(ReflectionState)
@@ -310,30 +379,61 @@ Return either:
         Unified streaming for both ReAct and Reflection graphs
         Uses centralized StreamingService for consistent model-specific patterns
         """
-        config = config or {}
+        return await self.deliver_stream(
+            self.astream_graph_iter(graph, inputs, config, graph_type),
+            callback
+        )
+    
+    async def astream_graph_iter(
+        self,
+        graph: CompiledStateGraph,
+        inputs: dict,
+        config: Optional[RunnableConfig] = None,
+        graph_type: str = "simple"
+    ) -> AsyncIterator[StreamPayload]:
+        """
+        Stream graph output as {"node", "content"} payloads as soon as they are produced,
+        ending with a FINAL_RESULT_NODE payload that carries the final result
+        """
         final_result = {}
         
-        # Store callback for tool nodes to access (legacy support)
-        self.current_callback = callback
+        # Payloads produced by the streaming service (and tool nodes) since the last yield
+        pending: List[StreamPayload] = []
+        
+        # Hand tool nodes this run's callback through the config rather than shared service state
+        config = config or {}
+        config = {**config, "configurable": {**config.get("configurable", {}), STREAM_CALLBACK_KEY: pending.append}}
         
-        # Reset streaming service state for new conversation
-        self.streaming_service.reset_state()
+        # Fresh streaming state per run so concurrent runs never share dedup sets or text buffers
+        streaming_service = StreamingService()
+        
+        # Bind hot-loop lookups once
+        process_stream_chunk = streaming_service.process_stream_chunk
+        chunk_msg = metadata = curr_node = None
         
         # Use messages mode for both graph types for consistency
-        async for chunk_msg, metadata in graph.astream(
-            inputs, config, stream_mode="messages"
-        ):
-            curr_node = metadata["langgraph_node"]
-            
-            # Use centralized streaming service for consistent handling
-            await self.streaming_service.process_stream_chunk(
-                chunk_msg=chunk_msg,
-                node_name=curr_node,
-                graph_type=graph_type,
-                callback=callback
-            )
-            
-            # Update final result
+        stream = graph.astream(inputs, config, stream_mode="messages")
+        try:
+            async for chunk_msg, metadata in stream:
+                curr_node = metadata["langgraph_node"]
+                
+                # Use centralized streaming service for consistent handling
+                await process_stream_chunk(chunk_msg, curr_node, graph_type, pending.append)
+                
+                if pending:
+                    batch = pending.copy()
+                    pending.clear()
+                    for payload in batch:
+                        yield payload
+        finally:
+            # Closing this iterator early (consumer gone) stops the graph run instead of orphaning it
+            await stream.aclose()
+        
+        for payload in pending:
+            yield payload
+        
+        # Build final result from the last chunk only
+        if metadata is not None:
             final_result = {
                 "node": curr_node,
                 "content": chunk_msg,
@@ -341,15 +441,69 @@ Return either:
             }
         
         # Extract final content using streaming service
-        final_content = self.streaming_service.extract_final_content()
+        final_content = streaming_service.extract_final_content()
         if final_content:
             final_result["collected_content"] = final_content
         elif hasattr(final_result.get("content"), "content"):
             # Fallback to extracting from final message
-            final_result["collected_content"] = str(final_result["content"].content)
+            final_result["collected_content"] = streaming_service.content_text(final_result["content"].content)
+        
+        yield StreamPayload(FINAL_RESULT_NODE, final_result)
+    
+    async def deliver_stream(
+        self,
+        stream: AsyncIterator[StreamPayload],
+        callback: Optional[Callable] = None
+    ) -> Dict[str, Any]:
+        """Feed stream payloads to a callback and return the content of the final result payload"""
+        final_result = {}
+        
+        # Deliver async callbacks from a consumer task so a slow writer doesn't stall the graph stream
+        consumer = None
+        if callback and asyncio.iscoroutinefunction(callback):
+            queue: asyncio.Queue = asyncio.Queue(maxsize=self.CALLBACK_QUEUE_SIZE)
+            consumer = asyncio.create_task(self._drain_callbacks(queue, callback))
+            callback = queue.put  # Awaited below; only blocks once the consumer is far behind
+        
+        try:
+            async for payload in stream:
+                if payload.node == FINAL_RESULT_NODE:
+                    final_result = payload.content
+                elif callback:
+                    try:
+                        result = callback(payload)
+                        if hasattr(result, "__await__"):
+                            await result
+                    except Exception as e:
+                        logger.error(f"Error in stream callback: {e}")
+        except BaseException:
+            if consumer:
+                consumer.cancel()
+            raise
+        
+        # Flush remaining callbacks before returning
+        if consumer:
+            await queue.put(None)
+            await consumer
         
         return final_result
     
+    async def _drain_callbacks(self, queue: asyncio.Queue, callback: Callable):
+        """Consume queued stream payloads and deliver them to the callback in order"""
+        while True:
+            batch = [await queue.get()]
+            # Take everything else already queued in one go
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            
+            for payload in batch:
+                if payload is None:
+                    return
+                try:
+                    await callback(payload)
+                except Exception as e:
+                    logger.error(f"Error in stream callback: {e}")
+    
     def _create_enhanced_tools(self, tools: Sequence[Any]) -> List[Dict[str, Any]]:
         """Add Complete tool to the tool list"""
         enhanced_tools = list(tools)
@@ -371,35 +525,36 @@ Return either:
         enhanced_tools.append(complete_tool)
         return enhanced_tools
     
-    def _extract_progress(self, tool_results: List[ToolMessage], current_progress: str) -> str:
-        """Extract progress from tool results - no truncation, full context"""
-        if not tool_results:
-            return current_progress
-        
+    def _cached_reflection(self, reflection_message: str) -> Optional[Tuple[bool, str]]:
+        """Get the cached verdict for an identical reflection prompt"""
+        if not self.enable_reflection_cache:
+            return None
+        key = hashlib.sha256(reflection_message.encode("utf-8")).hexdigest()
+        verdict = self._reflection_cache.get(key)
+        if verdict is not None:
+            self._reflection_cache.move_to_end(key)
+        return verdict
+    
+    def _cache_reflection(self, reflection_message: str, verdict: Tuple[bool, str]):
+        """Cache a parsed reflection verdict, evicting the least recently used"""
+        if not self.enable_reflection_cache:
+            return
+        key = hashlib.sha256(reflection_message.encode("utf-8")).hexdigest()
+        self._reflection_cache[key] = verdict
+        if len(self._reflection_cache) > self.MAX_REFLECTION_CACHE:
+            self._reflection_cache.popitem(last=False)
+    
+    def _extract_progress(self, tool_results: List[ToolMessage]) -> List[str]:
+        """Extract new progress entries from tool results (appended to state by the reducer)"""
         # Keep all tool results with full content - no truncation
-        results_summary = []
-        for result in tool_results:
-            results_summary.append(f"Used {result.name}: {result.content}")
-        
-        new_progress = "\n".join(results_summary)
-        
-        # Accumulate full progress - no truncation
-        if current_progress:
-            return f"{current_progress}\n{new_progress}"
-        return new_progress
+        return [f"Used {result.name}: {result.content}" for result in tool_results]
     
-    def _extract_work_summary(self, messages: List[BaseMessage]) -> str:
-        """Extract a summary of work completed from messages - full context"""
-        recent_messages = messages[-20:]  # Get more messages for full context
-        
-        summary_parts = []
-        for msg in recent_messages:
-            if isinstance(msg, ToolMessage):
-                # Keep full content - no truncation
-                summary_parts.append(f"Tool {msg.name}: {msg.content}")
-            elif isinstance(msg, AIMessage) and hasattr(msg, 'content'):
-                content = str(msg.content)
-                if content:
-                    summary_parts.append(f"Agent: {content}")
-        
-        return "\n".join(summary_parts)  # Return all parts
\ No newline at end of file
+    def _join_recent(self, entries: List[str], budget: int) -> str:
+        """Join the most recent entries that fit a character budget (always at least the last one)"""
+        start = len(entries)
+        while start > 0:
+            budget -= len(entries[start - 1]) + 1
+            if budget < 0 and start < len(entries):
+                break
+            start -= 1
+        return "\n".join(entries[start:])
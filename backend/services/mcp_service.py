@@ -1,7 +1,11 @@
+import asyncio
 import logging
+import traceback
+from itertools import chain
 from typing import Any
 from models import ToolInfo, ServerToolInfo, GroupedToolsResponse, ToolConfig
 from langchain_mcp_adapters.client import MultiServerMCPClient
+from langchain_mcp_adapters.tools import load_mcp_tools
 from .config_service import ConfigService
 
 logger = logging.getLogger(__name__)
@@ -11,62 +15,178 @@ class MCPService:
         self.config_service: ConfigService = config_service
         self.client: MultiServerMCPClient | None = None
         self._initialized: bool = False
+        self._current_config: dict[str, Any] = {}            # Server configs the client was built with
+        self._tools_by_server: dict[str, list[Any]] = {}     # Tools fetched per server, kept across reloads
+        self._epoch: int = 0                                 # Bumped whenever the loaded config changes
+        self._all_tools: tuple[int, list[Any]] | None = None   # (epoch, flattened tools of all servers)
+        self._grouped_tools: tuple[int, GroupedToolsResponse] | None = None  # (epoch, grouped listing)
+        # Open session per server: (holder task, close event, future resolving to the session)
+        self._sessions: dict[str, tuple[asyncio.Task, asyncio.Event, asyncio.Future]] = {}
 
     async def initialize(self) -> bool:
-        """Initialize MCP client with current configuration"""
+        """Initialize MCP client with current configuration, keeping tools of unchanged servers"""
         try:
-            await self.cleanup()
-            
-            config = self.config_service.load_config()
+            config = await self.config_service.aload_config()
             if not config:
+                await self.cleanup()
                 return False
             
+            # Only servers that were removed or whose config changed need their tools re-fetched
+            old_config = self._current_config
+            stale = (old_config.keys() - config.keys()) | {
+                name for name in config.keys() & old_config.keys() if config[name] != old_config[name]
+            }
+            for server_name in stale:
+                self._tools_by_server.pop(server_name, None)
+                await self._close_session(server_name)
+            self._epoch += 1
+            
             # Create single MultiServerMCP client - it handles all servers efficiently
             self.client = MultiServerMCPClient(config)
+            self._current_config = dict(config)
             
             self._initialized = True
             return True
             
         except Exception as e:
             logger.error(f"Error initializing MCP service: {str(e)}")
-            import traceback
             logger.error(f"Full traceback: {traceback.format_exc()}")
             return False
 
     async def cleanup(self):
         """Clean up existing client connection"""
+        for server_name in list(self._sessions):
+            await self._close_session(server_name)
         if self.client is not None:
             self.client = None
+        self._current_config = {}
+        self._tools_by_server.clear()
+        self._epoch += 1
         self._initialized = False
 
+    @property
+    def epoch(self) -> int:
+        """Version of the loaded tools; changes whenever previously returned tools may be stale"""
+        return self._epoch
+
+    async def _get_server_tools(self, server_name: str) -> list[Any]:
+        """Get tools of one server, fetching them only the first time after a (re)load"""
+        tools = self._tools_by_server.get(server_name)
+        if tools is None:
+            epoch = self._epoch
+            # Tools loaded from a kept-open session reuse it for every call instead of reconnecting
+            session = await self._open_session(server_name)
+            tools = await load_mcp_tools(session)
+            # Don't cache tools fetched under a config that was replaced meanwhile
+            if epoch == self._epoch:
+                self._tools_by_server[server_name] = tools
+        return tools
+
+    async def _open_session(self, server_name: str) -> Any:
+        """Get the open session of a server, connecting on first use"""
+        entry = self._sessions.get(server_name)
+        if entry is None:
+            opened = asyncio.get_running_loop().create_future()
+            close = asyncio.Event()
+            task = asyncio.create_task(self._hold_session(self.client, server_name, opened, close))
+            entry = self._sessions[server_name] = (task, close, opened)
+        try:
+            return await asyncio.shield(entry[2])
+        except Exception:
+            if self._sessions.get(server_name) is entry:
+                del self._sessions[server_name]
+            raise
+
+    async def _hold_session(
+        self,
+        client: MultiServerMCPClient,
+        server_name: str,
+        opened: asyncio.Future,
+        close: asyncio.Event
+    ):
+        """Keep a server session open until asked to close (MCP transports must exit in the task that entered them)"""
+        try:
+            async with client.session(server_name) as session:
+                opened.set_result(session)
+                await close.wait()
+        except Exception as e:
+            if not opened.done():
+                opened.set_exception(e)
+            else:
+                logger.warning(f"MCP session for server '{server_name}' closed with error: {e}")
+        finally:
+            # A session that ended on its own (server crashed, HTTP session expired) leaves dead tools
+            # behind: forget them so the next use reconnects, and bump the epoch so agents rebuild
+            entry = self._sessions.get(server_name)
+            if entry is not None and entry[0] is asyncio.current_task():
+                del self._sessions[server_name]
+                if opened.done() and not opened.cancelled() and opened.exception() is None:
+                    self._tools_by_server.pop(server_name, None)
+                    self._epoch += 1
+
+    async def _close_session(self, server_name: str):
+        """Close a server's session, if one is open"""
+        entry = self._sessions.pop(server_name, None)
+        if entry is None:
+            return
+        task, close, _ = entry
+        close.set()
+        try:
+            await task
+        except Exception as e:
+            logger.warning(f"Error closing MCP session for server '{server_name}': {e}")
+
     async def get_tools(self) -> list[Any]:
         """Get all available tools from all servers"""
         if not self.client:
             return []
-        return await self.client.get_tools()
+        if self._all_tools is not None and self._all_tools[0] == self._epoch:
+            return self._all_tools[1]
+        
+        epoch = self._epoch
+        # Fetch all servers not cached yet concurrently, so cold start costs the slowest server, not the sum
+        await asyncio.gather(*(
+            self._get_server_tools(server_name)
+            for server_name in self._current_config
+            if server_name not in self._tools_by_server
+        ))
+        tools = list(chain.from_iterable(self._tools_by_server.get(name, ()) for name in self._current_config))
+        if epoch == self._epoch and all(name in self._tools_by_server for name in self._current_config):
+            self._all_tools = (epoch, tools)
+        return tools
 
     async def get_grouped_tools(self) -> GroupedToolsResponse:
         """Get tools grouped by their server"""
         if not self.client:
             return GroupedToolsResponse(servers={})
+        if self._grouped_tools is not None and self._grouped_tools[0] == self._epoch:
+            return self._grouped_tools[1]
+        
+        epoch = self._epoch
             
-        config = self.config_service.load_config()
         servers = {}
         
-        for server_name in config.keys():
+        # Get tools from each server concurrently (cached until its config changes)
+        server_names = list(self._current_config)
+        results = await asyncio.gather(
+            *(self._get_server_tools(server_name) for server_name in server_names),
+            return_exceptions=True
+        )
+        
+        for server_name, server_tools in zip(server_names, results):
             try:
-                # Get tools from this specific server using efficient API
-                server_tools = await self.client.get_tools(server_name=server_name)
+                if isinstance(server_tools, Exception):
+                    raise server_tools
                 
-                tool_infos = []
-                for tool in server_tools:
-                    tool_info = ToolInfo(
+                tool_infos = [
+                    ToolInfo(
                         name=tool.name,
                         description=getattr(tool, 'description', None),
                         parameters=getattr(tool, 'args_schema', None),
                         server_name=server_name
                     )
-                    tool_infos.append(tool_info)
+                    for tool in server_tools
+                ]
                 
                 servers[server_name] = ServerToolInfo(
                     name=self._get_server_display_name(server_name),
@@ -77,7 +197,11 @@ class MCPService:
             except Exception as e:
                 logger.warning(f"Failed to get tools from server '{server_name}': {e}")
         
-        return GroupedToolsResponse(servers=servers)
+        grouped = GroupedToolsResponse(servers=servers)
+        # Only cache a complete listing so failed servers are retried next time
+        if len(servers) == len(server_names) and epoch == self._epoch:
+            self._grouped_tools = (epoch, grouped)
+        return grouped
     
     def _get_server_display_name(self, server_name: str) -> str:
         """Convert server name to display name"""
@@ -93,7 +217,7 @@ class MCPService:
         """Get number of available tools"""
         if not self.client:
             return 0
-        tools = await self.client.get_tools()
+        tools = await self.get_tools()
         return len(tools)
 
     def is_initialized(self) -> bool:
@@ -106,7 +230,7 @@ class MCPService:
             # Validate and add tool to config
             validated_config = ToolConfig(**tool_config)
             self.config_service.validate_tool_config(validated_config)
-            _ = self.config_service.add_tool(tool_name, validated_config)
+            _ = await self.config_service.aadd_tool(tool_name, validated_config)
             
             # Reinitialize client with new config
             return await self.initialize()
@@ -118,7 +242,7 @@ class MCPService:
     async def remove_tool(self, tool_name: str) -> bool:
         """Remove a tool and reinitialize client"""
         try:
-            _ = self.config_service.remove_tool(tool_name)
+            _ = await self.config_service.aremove_tool(tool_name)
             return await self.initialize()
         except Exception as e:
             logger.error(f"Error removing tool {tool_name}: {str(e)}")
@@ -127,28 +251,34 @@ class MCPService:
     async def update_config(self, new_config: dict[str, Any]) -> bool:
         """Update entire configuration and reinitialize client"""
         try:
-            _ = self.config_service.update_config(new_config)
+            _ = await self.config_service.aupdate_config(new_config)
             return await self.initialize()
         except Exception as e:
             logger.error(f"Error updating config: {str(e)}")
             return False
 
-    def get_config(self) -> dict[str, Any]:
-        """Get current MCP configuration"""
-        return self.config_service.load_config()
+    async def get_config(self) -> dict[str, Any]:
+        """Get current MCP configuration (the snapshot the client was last loaded with)"""
+        if self._initialized:
+            return dict(self._current_config)
+        return await self.config_service.aload_config()
     
     async def get_filtered_tools(self, enabled_tools: list[str] | None = None) -> list[Any]:
         """Get tools filtered by enabled server names"""
         if not self.client or not enabled_tools:
             return await self.get_tools()
         
+        results = await asyncio.gather(
+            *(self._get_server_tools(server_name) for server_name in enabled_tools),
+            return_exceptions=True
+        )
+        
         filtered_tools = []
-        for server_name in enabled_tools:
-            try:
-                server_tools = await self.client.get_tools(server_name=server_name)
+        for server_name, server_tools in zip(enabled_tools, results):
+            if isinstance(server_tools, Exception):
+                logger.warning(f"Failed to get tools from server '{server_name}': {server_tools}")
+            else:
                 filtered_tools.extend(server_tools)
-            except Exception as e:
-                logger.warning(f"Failed to get tools from server '{server_name}': {e}")
         
         return filtered_tools
     
@@ -159,23 +289,22 @@ class MCPService:
             test_config = {tool_name: tool_config}
             
             # Create temporary client to test connection
-            from langchain_mcp_adapters.client import MultiServerMCPClient
             test_client = MultiServerMCPClient(test_config)
             
             # Try to get tools from this server to test connection
-            server_tools = await test_client.get_tools(server_name=tool_name)
+            await test_client.get_tools(server_name=tool_name)
             
             # Connection successful - now add to actual config
             validated_config = ToolConfig(**tool_config)
             self.config_service.validate_tool_config(validated_config)
-            _ = self.config_service.add_tool(tool_name, validated_config)
+            _ = await self.config_service.aadd_tool(tool_name, validated_config)
             
-            # Reinitialize our main client with the new config
+            # Reinitialize our main client with the new config (other servers keep their cached tools);
+            # the new server's tools are loaded through a kept-open session on first use
             return await self.initialize()
             
         except Exception as e:
             logger.error(f"Failed to connect to MCP server '{tool_name}': {str(e)}")
-            import traceback
             logger.error(f"Full traceback: {traceback.format_exc()}")
             return False
     
@@ -1,76 +1,140 @@
+import asyncio
+import io
 import logging
-from typing import Any, Dict, List, Optional, Callable, Set
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Callable
 from langchain_core.messages import BaseMessage
 import json
 
 logger = logging.getLogger(__name__)
 
 
+class StreamPayload(NamedTuple):
+    """One streamed item: the graph node it came from and its content"""
+    node: str
+    content: Any
+
+
+def _blocks_text(content: list) -> str:
+    """Join the text of Anthropic content blocks, skipping tool_use and other blocks"""
+    return "".join(
+        block if isinstance(block, str) else block.get("text", "")
+        for block in content
+        if isinstance(block, str) or (isinstance(block, dict) and block.get("type") == "text")
+    )
+
+
+# Text extraction by content type; anything else is stringified
+_CONTENT_TEXT_HANDLERS: Dict[type, Callable[[Any], str]] = {
+    str: lambda content: content,
+    list: _blocks_text,
+}
+
+class _TextChunk:
+    """Minimal message-like chunk carrying one text block"""
+    __slots__ = ("content",)
+    
+    def __init__(self, content: str):
+        self.content = content
+
+
+# Graph node names normalized across graph types
+_NODE_MAP: Dict[str, str] = {
+    # ReAct graph nodes (from create_react_agent)
+    "__start__": "start",
+    "agent": "agent",
+    "tools": "tools",
+    "__end__": "end",
+    # Custom reflection graph nodes
+    "reflect": "reflect",
+}
+
+# Model type by content type: Anthropic streams lists of content blocks, OpenAI plain strings
+_MODEL_TYPE_BY_CONTENT: Dict[type, str] = {
+    list: "anthropic",
+    str: "openai",
+}
+
+
 class StreamingService:
     """Centralized service for handling model-specific streaming patterns"""
     
+    # Tool call ids remembered for de-duplication, oldest forgotten first
+    MAX_SEEN_TOOL_CALLS = 4096
+    
     def __init__(self):
-        self.seen_tool_calls: Set[str] = set()
-        self.node_chunks: Dict[str, Any] = {}
+        self.seen_tool_calls: OrderedDict[str, None] = OrderedDict()
+        self.node_text: Dict[str, io.StringIO] = {}
+        self._node_model: Dict[str, str] = {}  # Model type detected per node, sticky for the conversation
+        # Chunk handler by normalized node name; other nodes are ignored
+        self._handlers: Dict[str, Callable[[Any, str, Optional[Callable]], bool]] = {
+            "agent": self._dispatch_agent,
+            "start": self._dispatch_agent,
+            "tools": self.handle_tool_chunk,
+            "reflect": self._dispatch_reflect,
+        }
+        # Callback classified by _emit, and awaitables it returned for process_stream_chunk to await
+        self._callback: Optional[Callable] = None
+        self._callback_is_async = False
+        self._pending_awaits: List[Any] = []
         
     def reset_state(self):
         """Reset streaming state for new conversation"""
         self.seen_tool_calls.clear()
-        self.node_chunks.clear()
+        self.node_text.clear()
+        self._node_model.clear()
+    
+    def _accumulate_text(self, node_name: str, text: str):
+        """Append streamed text to the node's buffer"""
+        if not text:
+            return
+        buf = self.node_text.get(node_name)
+        if buf is None:
+            buf = self.node_text[node_name] = io.StringIO()
+        buf.write(text)
+    
+    def _emit(self, callback: Callable, payload: StreamPayload):
+        """Deliver a payload to the callback, collecting async results to be awaited once per chunk"""
+        # Classify the callback once rather than probing every result
+        if callback is not self._callback:
+            self._callback = callback
+            self._callback_is_async = asyncio.iscoroutinefunction(callback)
+        try:
+            result = callback(payload)
+        except Exception as e:
+            logger.error(f"Error in {payload.node} stream callback: {e}")
+            return
+        if self._callback_is_async:
+            self._pending_awaits.append(result)
     
     def detect_model_type(self, chunk_msg: Any) -> str:
         """Detect whether this is OpenAI or Anthropic based on chunk characteristics"""
-        # Check for tool calls first - both models can have them
-        if hasattr(chunk_msg, 'tool_calls') and chunk_msg.tool_calls:
-            # If it has structured content (list), it's likely Anthropic
-            if hasattr(chunk_msg, 'content') and isinstance(chunk_msg.content, list):
-                return "anthropic"
-            else:
-                # Otherwise, assume OpenAI (simpler structure)
-                return "openai"
+        model_type = _MODEL_TYPE_BY_CONTENT.get(type(getattr(chunk_msg, 'content', None)))
+        if model_type is not None:
+            return model_type
         
-        # Check content patterns
-        if hasattr(chunk_msg, 'content'):
-            content = chunk_msg.content
-            # Anthropic often has structured content (lists with dicts)
-            if isinstance(content, list):
-                return "anthropic"
-            # OpenAI typically has simple string content
-            elif isinstance(content, str):
-                return "openai"
-        
-        return "unknown"
+        # OpenAI may send no content alongside tool calls
+        return "openai" if getattr(chunk_msg, 'tool_calls', None) else "unknown"
     
     def handle_agent_chunk(
         self, 
         chunk_msg: Any, 
         node_name: str, 
-        callback: Optional[Callable] = None,
-        model_type: str = "unknown"
+        callback: Optional[Callable] = None
     ) -> bool:
         """
-        Handle agent node chunks with model-specific logic
+        Handle agent node chunks generically (model-specific routing happens in _dispatch_agent)
         Returns True if chunk was processed, False otherwise
         """
         if not hasattr(chunk_msg, 'content'):
             return False
             
-        # Accumulate chunks for proper spacing (both models)
-        if node_name not in self.node_chunks:
-            self.node_chunks[node_name] = chunk_msg
-        else:
-            # Use + operator to properly merge chunks (preserves spacing)
-            self.node_chunks[node_name] = self.node_chunks[node_name] + chunk_msg
+        # Accumulate text as written (preserves spacing) without re-merging message chunks
+        self._accumulate_text(node_name, self.content_text(chunk_msg.content))
         
         # Stream content if available and callback exists
         if callback and chunk_msg.content:
-            try:
-                result = callback({"node": node_name, "content": chunk_msg})
-                if hasattr(result, "__await__"):
-                    # Return coroutine for caller to await
-                    return result
-            except Exception as e:
-                logger.error(f"Error in agent chunk callback: {e}")
+            self._emit(callback, StreamPayload(node_name, chunk_msg))
         
         # Handle tool calls in agent response
         if hasattr(chunk_msg, 'tool_calls') and chunk_msg.tool_calls and callback:
@@ -93,77 +157,60 @@ class StreamingService:
             return False
             
         if callback:
-            try:
-                result = callback({"node": node_name, "content": chunk_msg})
-                if hasattr(result, "__await__"):
-                    return result
-            except Exception as e:
-                logger.error(f"Error in tool chunk callback: {e}")
+            self._emit(callback, StreamPayload(node_name, chunk_msg))
                 
         return True
     
-    def _handle_tool_call(self, tool_call: Dict[str, Any], callback: Callable):
+    def _handle_tool_call(self, tool_call: Dict[str, Any], callback: Optional[Callable]):
         """Handle individual tool call with consistent formatting"""
         tool_id = tool_call.get('id')
         tool_name = tool_call.get('name')
-        tool_args = tool_call.get('args', {})
         
-        if not tool_id or not tool_name:
+        # Skip incomplete and Complete tool calls before any bookkeeping
+        if not tool_id or not tool_name or tool_name == 'Complete' or not callback:
             return
             
         # Skip if we've already seen this tool call
         if tool_id in self.seen_tool_calls:
+            self.seen_tool_calls.move_to_end(tool_id)
             return
             
-        self.seen_tool_calls.add(tool_id)
-        
-        # Skip Complete tool calls
-        if tool_name == 'Complete':
-            return
+        self.seen_tool_calls[tool_id] = None
+        if len(self.seen_tool_calls) > self.MAX_SEEN_TOOL_CALLS:
+            self.seen_tool_calls.popitem(last=False)
             
-        try:
-            # Send tool call information
-            result = callback({
-                "node": "tool_args",
-                "content": {
-                    "tool_call_id": tool_id,
-                    "tool_name": tool_name,
-                    "args": tool_args
-                }
-            })
-            if hasattr(result, "__await__"):
-                return result
-        except Exception as e:
-            logger.error(f"Error sending tool call via callback: {e}")
+        # Send tool call information
+        self._emit(callback, StreamPayload("tool_args", {
+            "tool_call_id": tool_id,
+            "tool_name": tool_name,
+            "args": tool_call.get('args', {})
+        }))
     
     def normalize_node_name(self, node_name: str, graph_type: str = "simple") -> str:
         """
         Normalize node names across different graph types for consistent handling
         """
-        # Map different graph node names to consistent names
-        node_mapping = {
-            # ReAct graph nodes (from create_react_agent)
-            "__start__": "start",
-            "agent": "agent", 
-            "tools": "tools",
-            "__end__": "end",
-            # Custom reflection graph nodes
-            "reflect": "reflect",
-            # Add more mappings as needed
-        }
-        
-        return node_mapping.get(node_name, node_name)
+        return _NODE_MAP.get(node_name, node_name)
+    
+    @staticmethod
+    def content_text(content: Any) -> str:
+        """Get the text of message content, reading content blocks directly instead of stringifying them"""
+        handler = _CONTENT_TEXT_HANDLERS.get(type(content))
+        if handler is not None:
+            return handler(content)
+        return str(content) if content else ""
     
     def extract_final_content(self) -> str:
         """Extract final accumulated content for response"""
-        # Prefer agent chunks (properly spaced) over other content
-        if 'agent' in self.node_chunks and hasattr(self.node_chunks['agent'], 'content'):
-            return str(self.node_chunks['agent'].content)
+        # Prefer agent text over other content
+        buf = self.node_text.get('agent')
+        if buf is not None and buf.tell() > 0:
+            return buf.getvalue()
         
         # Fallback to any accumulated content
-        for node_name, chunk in self.node_chunks.items():
-            if hasattr(chunk, 'content') and chunk.content:
-                return str(chunk.content)
+        for buf in self.node_text.values():
+            if buf.tell() > 0:
+                return buf.getvalue()
                 
         return ""
     
@@ -179,34 +226,43 @@ class StreamingService:
             
         content = chunk_msg.content
         
+        # Plain string content (the model type is sticky per node) takes the generic path
+        if not isinstance(content, list):
+            return self.handle_agent_chunk(chunk_msg, node_name, callback)
+        
         # Handle structured content (list of content blocks)
-        if isinstance(content, list):
-            for item in content:
-                if isinstance(item, dict):
-                    if item.get("type") == "text":
-                        # Handle text content
-                        text = item.get("text", "")
-                        if text and callback:
-                            try:
-                                # Create a simplified chunk for streaming
-                                text_chunk = type('Chunk', (), {'content': text})()
-                                result = callback({"node": node_name, "content": text_chunk})
-                                if hasattr(result, "__await__"):
-                                    return result
-                            except Exception as e:
-                                logger.error(f"Error streaming Anthropic text: {e}")
-                    
-                    elif item.get("type") == "tool_use":
-                        # Handle tool use blocks
-                        tool_call = {
-                            'id': item.get('id'),
-                            'name': item.get('name'),
-                            'args': item.get('input', {})
-                        }
-                        self._handle_tool_call(tool_call, callback)
+        # Coalesce each run of consecutive text blocks into one payload, keeping tool_use blocks in order
+        text_run: List[str] = []
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            block_type = item.get("type")
+            if block_type == "text":
+                text_run.append(item.get("text", ""))
+            elif block_type == "tool_use":
+                self._flush_text_run(text_run, node_name, callback)
+                # Handle tool use blocks
+                tool_call = {
+                    'id': item.get('id'),
+                    'name': item.get('name'),
+                    'args': item.get('input', {})
+                }
+                self._handle_tool_call(tool_call, callback)
+        self._flush_text_run(text_run, node_name, callback)
                         
         return True
     
+    def _flush_text_run(self, text_run: List[str], node_name: str, callback: Optional[Callable]):
+        """Accumulate and stream a run of text blocks as one chunk, then empty the run"""
+        if not text_run:
+            return
+        text = "".join(text_run)
+        text_run.clear()
+        self._accumulate_text(node_name, text)
+        if text and callback:
+            # Create a simplified chunk for streaming
+            self._emit(callback, StreamPayload(node_name, _TextChunk(text)))
+    
     def handle_openai_patterns(
         self, 
         chunk_msg: Any, 
@@ -218,7 +274,7 @@ class StreamingService:
         
         # Handle text content first
         if hasattr(chunk_msg, 'content') and chunk_msg.content:
-            processed = self.handle_agent_chunk(chunk_msg, node_name, callback, "openai")
+            processed = self.handle_agent_chunk(chunk_msg, node_name, callback)
         
         # Handle tool calls separately (for mixed responses)
         if hasattr(chunk_msg, 'tool_calls') and chunk_msg.tool_calls and callback:
@@ -228,6 +284,27 @@ class StreamingService:
             
         return processed
     
+    def _dispatch_agent(self, chunk_msg: Any, node_name: str, callback: Optional[Callable] = None) -> bool:
+        """Handle agent chunks with the patterns of the detected model type"""
+        # The model doesn't change within a conversation, so detect once per node
+        model_type = self._node_model.get(node_name)
+        if model_type is None:
+            model_type = self.detect_model_type(chunk_msg)
+            if model_type != "unknown":
+                self._node_model[node_name] = model_type
+        if model_type == "anthropic":
+            return self.handle_anthropic_patterns(chunk_msg, node_name, callback)
+        if model_type == "openai":
+            return self.handle_openai_patterns(chunk_msg, node_name, callback)
+        # Fallback to generic handling
+        return self.handle_agent_chunk(chunk_msg, node_name, callback)
+    
+    def _dispatch_reflect(self, chunk_msg: Any, node_name: str, callback: Optional[Callable] = None) -> bool:
+        """Handle reflection node chunks (extended graph only)"""
+        if hasattr(chunk_msg, 'content') and chunk_msg.content and callback:
+            self._emit(callback, StreamPayload(node_name, chunk_msg))
+        return True
+    
     async def process_stream_chunk(
         self,
         chunk_msg: Any,
@@ -239,37 +316,17 @@ class StreamingService:
         Main entry point for processing stream chunks
         Automatically detects model type and applies appropriate patterns
         """
-        normalized_node = self.normalize_node_name(node_name, graph_type)
-        
-        # Detect model type if not specified
-        model_type = self.detect_model_type(chunk_msg)
-        
-        if normalized_node in ['agent', 'start']:
-            if model_type == "anthropic":
-                result = self.handle_anthropic_patterns(chunk_msg, node_name, callback)
-            elif model_type == "openai":
-                result = self.handle_openai_patterns(chunk_msg, node_name, callback)
-            else:
-                # Fallback to generic handling
-                result = self.handle_agent_chunk(chunk_msg, node_name, callback)
+        handler = self._handlers.get(self.normalize_node_name(node_name, graph_type))
+        if handler is not None:
+            handler(chunk_msg, node_name, callback)
             
-            # Await if result is a coroutine
-            if hasattr(result, "__await__"):
-                await result
-                
-        elif normalized_node == 'tools':
-            result = self.handle_tool_chunk(chunk_msg, node_name, callback)
-            if hasattr(result, "__await__"):
-                await result
-                
-        elif normalized_node == 'reflect':
-            # Handle reflection node (extended graph only)
-            if hasattr(chunk_msg, 'content') and chunk_msg.content and callback:
-                try:
-                    result = callback({"node": node_name, "content": chunk_msg})
-                    if hasattr(result, "__await__"):
-                        await result
-                except Exception as e:
-                    logger.error(f"Error in reflection callback: {e}")
+            # Await whatever an async callback returned, in emission order
+            if self._pending_awaits:
+                pending, self._pending_awaits = self._pending_awaits, []
+                for awaitable in pending:
+                    try:
+                        await awaitable
+                    except Exception as e:
+                        logger.error(f"Error in stream callback: {e}")
         
-        return True
\ No newline at end of file
+        return True